@@ -14,5 +14,7 @@ import delivery
 import stock_picking
 import stock_tracking
 import payment_invoice
+import api_stats
+import import_payload
 
 import consumer
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from datetime import datetime, timedelta
+
+from openerp.osv import orm, fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from .unit.api_stats import LATENCY_BUCKETS
+
+# Number of days the statistics are kept
+STATS_RETENTION_DAYS = 30
+
+
+class magento_api_stats(orm.Model):
+    """ Statistics of the calls to the Magento API, per hour.
+
+    Written by the collector of the adapters
+    (:mod:`~openerp.addons.magentoerpconnect.unit.api_stats`).  The rows
+    are only inserted, never updated, so the workers never wait for each
+    other: a method has a row per hour and per write of each worker,
+    they are summed when they are grouped.  They are deleted after
+    ``STATS_RETENTION_DAYS`` days by a daily cron.
+    """
+    _name = 'magento.api.stats'
+    _description = 'Magento API Statistics'
+    _order = 'date DESC, total_duration DESC'
+    _rec_name = 'method'
+
+    def _get_avg_duration(self, cr, uid, ids, name, arg, context=None):
+        res = {}
+        for stats in self.browse(cr, uid, ids, context=context):
+            if stats.call_count:
+                res[stats.id] = stats.total_duration / stats.call_count
+            else:
+                res[stats.id] = 0.
+        return res
+
+    _columns = {
+        'backend_id': fields.many2one('magento.backend',
+                                      'Magento Backend',
+                                      required=True,
+                                      readonly=True,
+                                      ondelete='cascade'),
+        'method': fields.char('Method', required=True, readonly=True,
+                              select=True),
+        'date': fields.datetime('Hour', required=True, readonly=True,
+                                select=True),
+        'call_count': fields.integer('Calls', readonly=True),
+        'fault_count': fields.integer('Faults', readonly=True),
+        'faults': fields.text('Fault Codes', readonly=True,
+                              help="Number of faults per code"),
+        'total_duration': fields.float('Total Duration (s)', readonly=True),
+        'max_duration': fields.float('Max Duration (s)', readonly=True,
+                                     group_operator='max'),
+        'avg_duration': fields.function(_get_avg_duration,
+                                        string='Average Duration (s)',
+                                        type='float'),
+        'response_size': fields.integer(
+            'Responses Size', readonly=True,
+            help="Approximative size of the responses, without the XML"),
+        'latency_0': fields.integer('<= %ss' % LATENCY_BUCKETS[0],
+                                    readonly=True),
+        'latency_1': fields.integer('<= %ss' % LATENCY_BUCKETS[1],
+                                    readonly=True),
+        'latency_2': fields.integer('<= %ss' % LATENCY_BUCKETS[2],
+                                    readonly=True),
+        'latency_3': fields.integer('<= %ss' % LATENCY_BUCKETS[3],
+                                    readonly=True),
+        'latency_4': fields.integer('> %ss' % LATENCY_BUCKETS[3],
+                                    readonly=True),
+    }
+
+    @staticmethod
+    def _format_faults(faults):
+        return '\n'.join('%s: %d' % (code, count)
+                         for code, count in sorted(faults.iteritems()))
+
+    def add_stats(self, cr, uid, stats_list, context=None):
+        """ Insert the statistics collected by a process in the current
+        hour
+
+        :param stats_list: list of tuples (backend id, method,
+                           :class:`~.unit.api_stats.MethodStats`)
+        """
+        hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        hour = hour.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        backend_obj = self.pool.get('magento.backend')
+        backend_ids = set(backend_obj.exists(
+            cr, uid, list(set(backend_id for backend_id, __, __
+                              in stats_list)),
+            context=context))
+        for backend_id, method, stats in stats_list:
+            if backend_id not in backend_ids:
+                continue
+            vals = {
+                'backend_id': backend_id,
+                'method': method,
+                'date': hour,
+                'call_count': stats.count,
+                'fault_count': stats.fault_count,
+                'faults': self._format_faults(stats.faults),
+                'total_duration': stats.total_duration,
+                'max_duration': stats.max_duration,
+                'response_size': stats.response_size,
+            }
+            for index, count in enumerate(stats.latencies):
+                vals['latency_%d' % index] = count
+            self.create(cr, uid, vals, context=context)
+        return True
+
+    def purge(self, cr, uid, context=None):
+        """ Delete the statistics older than ``STATS_RETENTION_DAYS``
+        days """
+        limit = datetime.now() - timedelta(days=STATS_RETENTION_DAYS)
+        limit = limit.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        stats_ids = self.search(cr, uid, [('date', '<', limit)],
+                                context=context)
+        if stats_ids:
+            self.unlink(cr, uid, stats_ids, context=context)
+        return True
+
+    def _scheduler_purge(self, cr, uid, context=None):
+        self.purge(cr, uid, context=context)
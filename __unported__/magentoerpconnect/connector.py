@@ -19,21 +19,166 @@
 #
 ##############################################################################
 
+from collections import namedtuple
+
 from openerp.osv import orm, fields
 from openerp.addons.connector.connector import (Environment,
                                                 install_in_connector)
 from openerp.addons.connector.checkpoint import checkpoint
+from .unit.worker_cache import WorkerCache
 
 install_in_connector()
 
+# Configuration of the backends, per database and backend
+_backend_config_cache = WorkerCache()
+
+
+class BackendConfig(namedtuple('BackendConfig',
+                               'config_version id name version '
+                               'location username password '
+                               'use_custom_api_path use_auth_basic '
+                               'auth_basic_username auth_basic_password '
+                               'default_lang_code storeviews websites '
+                               'warehouse_id stock_location_id stock_field '
+                               'api_max_concurrency api_rate_limit '
+                               'api_latency_threshold use_import_staging')):
+    """ Immutable snapshot of the configuration of a ``magento.backend``
+
+    The attributes have the names of the fields of the backend, plus:
+
+    * ``config_version``: version of the configuration in the database
+      (see :func:`_backend_config_version`), the snapshots of different
+      configurations have different versions
+    * ``default_lang_code``: code of the default language, None if the
+      backend has no default language
+    * ``storeviews``: tuple of (magento id, language code or None) of the
+      storeviews of the backend
+    * ``websites``: tuple of (binding id, magento id) of the websites
+    * ``stock_location_id``: stock location of the warehouse
+    * ``stock_field``: name of the field used for the stock quantities
+    """
+    __slots__ = ()
+
+    @property
+    def lang_code(self):
+        """ Language used by the synchronizations """
+        return self.default_lang_code or 'en_US'
+
+
+def _backend_config_version(cr, backend_id):
+    """ Version of the configuration of a backend, changed when the
+    configuration of the backend, its websites, storeviews, warehouse or
+    stock location are modified """
+    cr.execute("SELECT b.config_revision, "
+               "       (SELECT max(write_date) FROM magento_website "
+               "        WHERE backend_id = b.id), "
+               "       (SELECT count(*) FROM magento_website "
+               "        WHERE backend_id = b.id), "
+               "       (SELECT max(write_date) FROM magento_storeview "
+               "        WHERE backend_id = b.id), "
+               "       (SELECT count(*) FROM magento_storeview "
+               "        WHERE backend_id = b.id), "
+               "       w.write_date, "
+               "       l.write_date "
+               "FROM magento_backend b "
+               "LEFT JOIN stock_warehouse w ON w.id = b.warehouse_id "
+               "LEFT JOIN stock_location l ON l.id = w.lot_stock_id "
+               "WHERE b.id = %s", (backend_id,))
+    return cr.fetchone()
+
+
+def _load_backend_config(session, backend_id, config_version):
+    backend = session.browse('magento.backend', backend_id)
+    storeview_ids = session.search('magento.storeview',
+                                   [('backend_id', '=', backend_id)])
+    storeviews = tuple((storeview.magento_id,
+                        storeview.lang_id.code if storeview.lang_id else None)
+                       for storeview in session.browse('magento.storeview',
+                                                       storeview_ids))
+    website_ids = session.search('magento.website',
+                                 [('backend_id', '=', backend_id)])
+    websites = tuple((website.id, website.magento_id)
+                     for website in session.browse('magento.website',
+                                                   website_ids))
+    if backend.product_stock_field_id:
+        stock_field = backend.product_stock_field_id.name
+    else:
+        stock_field = 'virtual_available'
+    lang = backend.default_lang_id
+    return BackendConfig(
+        config_version=config_version,
+        id=backend.id,
+        name=backend.name,
+        version=backend.version,
+        location=backend.location,
+        username=backend.username,
+        password=backend.password,
+        use_custom_api_path=backend.use_custom_api_path,
+        use_auth_basic=backend.use_auth_basic,
+        auth_basic_username=backend.auth_basic_username,
+        auth_basic_password=backend.auth_basic_password,
+        default_lang_code=lang.code if lang else None,
+        storeviews=storeviews,
+        websites=websites,
+        warehouse_id=backend.warehouse_id.id,
+        stock_location_id=backend.warehouse_id.lot_stock_id.id,
+        stock_field=stock_field,
+        api_max_concurrency=backend.api_max_concurrency,
+        api_rate_limit=backend.api_rate_limit,
+        api_latency_threshold=backend.api_latency_threshold,
+        use_import_staging=backend.use_import_staging,
+    )
+
+
+def get_backend_config(session, backend_id):
+    """ Return the cached :class:`BackendConfig` of a backend
+
+    The cached configuration is validated with one query on the
+    database (:func:`_backend_config_version`), once per session, so
+    once per job (see :func:`reset_backend_config`).
+    """
+    configs = getattr(session, '_magento_backend_configs', None)
+    if configs is None:
+        configs = session._magento_backend_configs = {}
+    if backend_id not in configs:
+        cr = session.cr
+        version = _backend_config_version(cr, backend_id)
+
+        def compute():
+            return _load_backend_config(session, backend_id, version)
+
+        configs[backend_id] = _backend_config_cache.get(
+            (cr.dbname, backend_id), compute, version=version)
+    return configs[backend_id]
+
+
+def reset_backend_config(session):
+    """ Check again the version of the configurations on the next
+    access, when a backend, website or storeview has been modified in
+    the session """
+    session._magento_backend_configs = {}
+
+
+def backend_config(environment):
+    """ Return the :class:`BackendConfig` of an environment
+
+    The environments created by :func:`get_environment` already have
+    their configuration, it is loaded for the other ones.
+    """
+    config = getattr(environment, 'backend_config', None)
+    if config is None:
+        config = get_backend_config(environment.session,
+                                    environment.backend_record.id)
+        environment.backend_config = config
+    return config
+
 
 def get_environment(session, model_name, backend_id):
     """ Create an environment to work with.  """
     backend_record = session.browse('magento.backend', backend_id)
     env = Environment(backend_record, session, model_name)
-    lang = backend_record.default_lang_id
-    lang_code = lang.code if lang else 'en_US'
-    env.set_lang(code=lang_code)
+    env.backend_config = get_backend_config(session, backend_id)
+    env.set_lang(code=env.backend_config.lang_code)
     return env
 
 
@@ -57,11 +202,38 @@ class magento_binding(orm.AbstractModel):
             ondelete='restrict'),
         # fields.char because 0 is a valid Magento ID
         'magento_id': fields.char('ID on Magento'),
+        'magento_hash': fields.char(
+            'Hash of the Magento Data',
+            size=40,
+            readonly=True,
+            help="Digest of the data of the last import, used to skip "
+                 "the import when the data did not change. "
+                 "Emptied by the exports."),
     }
 
     # the _sql_contraints cannot be there due to this bug:
     # https://bugs.launchpad.net/openobject-server/+bug/1151703
 
+    def write(self, cr, uid, ids, vals, context=None):
+        if set(vals).intersection(('magento_id', 'openerp_id',
+                                   'backend_id')):
+            # the binders keep the bindings in a cache
+            from .unit.binder import invalidate_binding_cache
+            if not hasattr(ids, '__iter__'):
+                ids = [ids]
+            invalidate_binding_cache(cr, self._name, binding_ids=ids)
+        return super(magento_binding, self).write(cr, uid, ids, vals,
+                                                  context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        # the binders keep the bindings in a cache
+        from .unit.binder import invalidate_binding_cache
+        if not hasattr(ids, '__iter__'):
+            ids = [ids]
+        invalidate_binding_cache(cr, self._name, binding_ids=ids)
+        return super(magento_binding, self).unlink(cr, uid, ids,
+                                                   context=context)
+
 
 def add_checkpoint(session, model_name, record_id, backend_id):
     """ Add a row in the model ``connector.checkpoint`` for a record,
@@ -19,19 +19,110 @@
 #
 ##############################################################################
 
+import logging
+
+import psycopg2
+
+from openerp import SUPERUSER_ID
+from openerp.osv import orm, fields
+from openerp.tools.translate import _
 from openerp.addons.connector.event import (on_record_write,
                                             on_record_create,
                                             on_record_unlink
                                             )
 from openerp.addons.connector.connector import Binder
+from openerp.addons.connector.queue.job import OpenERPJobStorage, PENDING
 from .unit.export_synchronizer import export_record
 from .unit.delete_synchronizer import export_delete_record
+from .unit.import_synchronizer import savepoint
 from .connector import get_environment
 
+_logger = logging.getLogger(__name__)
+
 _MODEL_NAMES = ()
 _BIND_MODEL_NAMES = ()
 
 
+class queue_job(orm.Model):
+    _inherit = 'queue.job'
+
+    _columns = {
+        'magento_export_key': fields.char(
+            'Magento Export Key',
+            readonly=True,
+            select=True,
+            help="Binding exported by the job, used to merge the pending "
+                 "exports of a binding"),
+    }
+
+
+def _export_key(model_name, binding_id):
+    return '%s,%d' % (model_name, binding_id)
+
+
+def _lock_pending_exports(session, storage, model_name, binding_id):
+    """ Return the pending export jobs of a binding, locked
+
+    When a job is being enqueued by a worker (locked), the jobs are not
+    merged.
+    """
+    cr = session.cr
+    job_ids = storage.job_model.search(
+        cr, SUPERUSER_ID,
+        [('magento_export_key', '=', _export_key(model_name, binding_id)),
+         ('state', '=', PENDING)],
+        context=session.context)
+    if not job_ids:
+        return []
+    try:
+        with savepoint(cr, 'magento_lock_pending_exports'):
+            # a lock conflict is expected, do not log it as an error
+            cr.execute("SELECT uuid FROM queue_job "
+                       "WHERE id IN %s AND state = %s "
+                       "FOR UPDATE NOWAIT",
+                       (tuple(job_ids), PENDING),
+                       log_exceptions=False)
+            uuids = [row[0] for row in cr.fetchall()]
+    except psycopg2.OperationalError:
+        _logger.debug('The pending exports of %s %d are locked, they are '
+                      'not merged', model_name, binding_id)
+        return []
+    return [storage.load(uuid) for uuid in uuids]
+
+
+def delay_export_record(session, model_name, binding_id, fields=None):
+    """ Delay a job which export a binding record, merged with the
+    export jobs of the binding still pending.
+
+    The pending jobs are set as done and the new job exports the union
+    of their fields, so a burst of writes on a record leads to a single
+    export.  ``None`` as fields means all the fields.
+    """
+    storage = OpenERPJobStorage(session)
+    if fields is not None:
+        fields = set(fields)
+    for job_ in _lock_pending_exports(session, storage,
+                                      model_name, binding_id):
+        job_fields = job_.kwargs.get('fields')
+        if fields is None or job_fields is None:
+            fields = None
+        else:
+            fields.update(job_fields)
+        job_.set_done(result=_('Merged in a new export job.'))
+        storage.store(job_)
+    if fields is not None:
+        fields = sorted(fields)
+    job_uuid = export_record.delay(session, model_name, binding_id,
+                                   fields=fields)
+    job_ids = storage.job_model.search(session.cr, SUPERUSER_ID,
+                                       [('uuid', '=', job_uuid)],
+                                       context=session.context)
+    storage.job_model.write(
+        session.cr, SUPERUSER_ID, job_ids,
+        {'magento_export_key': _export_key(model_name, binding_id)},
+        context=session.context)
+
+
 @on_record_create(model_names=_BIND_MODEL_NAMES)
 @on_record_write(model_names=_BIND_MODEL_NAMES)
 def delay_export(session, model_name, record_id, vals):
@@ -43,7 +134,7 @@ def delay_export(session, model_name, record_id, vals):
     if session.context.get('connector_no_export'):
         return
     fields = vals.keys()
-    export_record.delay(session, model_name, record_id, fields=fields)
+    delay_export_record(session, model_name, record_id, fields=fields)
 
 
 @on_record_write(model_names=_MODEL_NAMES)
@@ -60,7 +151,7 @@ def delay_export_all_bindings(session, model_name, record_id, vals):
                           record_id, context=session.context)
     fields = vals.keys()
     for binding in record.magento_bind_ids:
-        export_record.delay(session, binding._model._name, binding.id,
+        delay_export_record(session, binding._model._name, binding.id,
                             fields=fields)
 
 
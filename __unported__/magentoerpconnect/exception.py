@@ -24,3 +24,8 @@ from openerp.addons.connector.exception import RetryableJobError
 
 class OrderImportRuleRetry(RetryableJobError):
     """ The sale order import will be retried later. """
+
+
+class BackendUnavailable(RetryableJobError):
+    """ The Magento backend is considered unavailable after too many
+    failures, the job will be retried later. """
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import base64
+import hashlib
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from openerp.osv import orm, fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+from openerp.addons.connector.session import ConnectorSession
+from .unit.import_synchronizer import (apply_payload,
+                                       find_or_create,
+                                       json_default,
+                                       )
+
+# Number of days the imported payloads are kept, they can be imported
+# again during this time
+PAYLOAD_RETENTION_DAYS = 7
+
+
+class magento_import_payload(orm.Model):
+    """ Data of a record read from Magento, waiting to be imported.
+
+    When the staging of the imports is activated on the backend, the
+    records are read from Magento by ``fetch_record`` jobs which store
+    their data here, then ``apply_payload`` jobs import them without
+    reading them on Magento.
+    """
+    _name = 'magento.import.payload'
+    _description = 'Magento Import Payload'
+    _order = 'id DESC'
+    _rec_name = 'magento_id'
+
+    _columns = {
+        'backend_id': fields.many2one('magento.backend',
+                                      'Magento Backend',
+                                      required=True,
+                                      readonly=True,
+                                      ondelete='cascade'),
+        'model': fields.char('Model', required=True, readonly=True),
+        'magento_id': fields.char('ID on Magento', required=True,
+                                  readonly=True),
+        'updated_at': fields.char('Updated At (on Magento)', readonly=True),
+        'data_hash': fields.char('Data Hash', readonly=True,
+                                 help="SHA1 digest of the data"),
+        'data': fields.binary('Compressed Data', readonly=True),
+        'size': fields.integer('Size', readonly=True,
+                               help="Size of the uncompressed data"),
+        'state': fields.selection([('pending', 'Pending'),
+                                   ('done', 'Imported')],
+                                  string='State',
+                                  required=True,
+                                  readonly=True),
+        'date_done': fields.datetime('Imported At', readonly=True),
+    }
+
+    _defaults = {
+        'state': 'pending',
+    }
+
+    _sql_constraints = [
+        ('payload_uniq', 'unique(backend_id, model, magento_id, data_hash)',
+         "The same data of this record are already stored"),
+    ]
+
+    def store(self, cr, uid, backend_id, model, magento_id, record,
+              context=None):
+        """ Store the data of a record read from Magento
+
+        The same data of a record are stored once, identified by their
+        digest, whether the record has an ``updated_at`` or not.  When
+        they are already stored, they wait again to be imported.
+
+        :return: id of the payload
+        """
+        data = json.dumps(record, sort_keys=True, default=json_default)
+        data_hash = hashlib.sha1(data).hexdigest()
+        domain = [('backend_id', '=', backend_id),
+                  ('model', '=', model),
+                  ('magento_id', '=', str(magento_id)),
+                  ('data_hash', '=', data_hash)]
+        vals = {'backend_id': backend_id,
+                'model': model,
+                'magento_id': str(magento_id),
+                'updated_at': record.get('updated_at') or False,
+                'data_hash': data_hash,
+                'data': base64.b64encode(zlib.compress(data)),
+                'size': len(data),
+                }
+        payload_id = find_or_create(cr, uid, self, domain, vals,
+                                    context=context)
+        self.write(cr, uid, [payload_id],
+                   {'state': 'pending', 'date_done': False},
+                   context=context)
+        return payload_id
+
+    def load(self, cr, uid, payload_id, context=None):
+        """ Return the data of a record stored with :meth:`store` """
+        payload = self.read(cr, uid, payload_id, ['data'], context=context)
+        return json.loads(zlib.decompress(base64.b64decode(payload['data'])))
+
+    def load_pending(self, cr, uid, payload_id, context=None):
+        """ Return the data of a record stored with :meth:`store` if
+        they are waiting to be imported, otherwise return None """
+        if not self.exists(cr, uid, payload_id, context=context):
+            return None
+        payload = self.read(cr, uid, payload_id, ['state'], context=context)
+        if payload['state'] != 'pending':
+            return None
+        return self.load(cr, uid, payload_id, context=context)
+
+    def mark_done(self, cr, uid, ids, context=None):
+        now = time.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        return self.write(cr, uid, ids, {'state': 'done', 'date_done': now},
+                          context=context)
+
+    def action_import(self, cr, uid, ids, context=None):
+        """ Import the records again from their stored data """
+        session = ConnectorSession(cr, uid, context=context)
+        for payload in self.browse(cr, uid, ids, context=context):
+            apply_payload.delay(session,
+                                payload.model,
+                                payload.backend_id.id,
+                                payload.id,
+                                force=True)
+        return True
+
+    def purge(self, cr, uid, context=None):
+        """ Delete the payloads imported since more than
+        ``PAYLOAD_RETENTION_DAYS`` days """
+        limit = datetime.now() - timedelta(days=PAYLOAD_RETENTION_DAYS)
+        limit = limit.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        payload_ids = self.search(cr, uid,
+                                  [('state', '=', 'done'),
+                                   ('date_done', '<', limit)],
+                                  context=context)
+        if payload_ids:
+            self.unlink(cr, uid, payload_ids, context=context)
+        return True
+
+    def _scheduler_purge(self, cr, uid, context=None):
+        self.purge(cr, uid, context=context)
@@ -40,7 +40,10 @@ from .unit.import_synchronizer import (import_batch,
 from .partner import partner_import_batch
 from .sale import sale_order_import_batch
 from .backend import magento
-from .connector import add_checkpoint
+from .connector import (add_checkpoint,
+                        BackendConfig,
+                        reset_backend_config,
+                        )
 
 _logger = logging.getLogger(__name__)
 
@@ -144,7 +147,47 @@ class magento_backend(orm.Model):
             'Import products from date'),
         'import_categories_from_date': fields.datetime(
             'Import categories from date'),
+        'import_products_chunk_size': fields.integer(
+            'Products per Import Job',
+            help="When greater than 1, the products are imported by "
+                 "chunks of this size, one job importing a whole chunk. "
+                 "Otherwise, a job is created for each product."),
+        'import_categories_chunk_size': fields.integer(
+            'Product Categories per Import Job',
+            help="The product categories of a level of the tree are "
+                 "imported by chunks of this size, one job importing a "
+                 "whole chunk, the chunks are imported one after the "
+                 "other. When 0 or 1, a job is created for each "
+                 "category."),
+        'import_partners_chunk_size': fields.integer(
+            'Partners per Import Job',
+            help="When greater than 1, the partners are imported by "
+                 "chunks of this size, one job importing a whole chunk. "
+                 "Otherwise, a job is created for each partner."),
         'catalog_price_tax_included': fields.boolean('Prices include tax'),
+        'use_import_staging': fields.boolean(
+            'Stage the Imports',
+            help="The batch imports read the records from Magento in "
+                 "jobs which store their data, other jobs import the "
+                 "stored data. The stored data can be imported again "
+                 "during a few days."),
+        'api_max_concurrency': fields.integer(
+            'Max. Concurrent Calls',
+            help="Maximum number of calls done at the same time on "
+                 "Magento by all the workers. 0 means no limit. "
+                 "Each worker lowers the limit automatically when "
+                 "Magento seems overloaded."),
+        'api_rate_limit': fields.float(
+            'Max. Calls per Second',
+            help="Maximum number of calls per second done on Magento "
+                 "by each worker. 0 means no limit. The limit is "
+                 "automatically lowered when Magento seems overloaded."),
+        'api_latency_threshold': fields.float(
+            'Overload Response Time',
+            help="Magento is considered overloaded when a call takes "
+                 "more than this time (in seconds), as when it answers "
+                 "with server errors. 0 means that the response time "
+                 "is not considered."),
         'product_stock_field_id': fields.many2one(
             'ir.model.fields',
             string='Stock Field',
@@ -157,12 +200,21 @@ class magento_backend(orm.Model):
                                                'backend_id',
                                                string='Magento Products',
                                                readonly=True),
+        'config_revision': fields.integer(
+            'Configuration Revision',
+            readonly=True,
+            help="Incremented when the configuration of the backend "
+                 "changes, the workers load it again"),
     }
 
     _defaults = {
+        'config_revision': 0,
         'product_stock_field_id': _get_stock_field_id,
         'use_custom_api_path': False,
         'use_auth_basic': False,
+        'import_categories_chunk_size': 100,
+        'api_max_concurrency': 0,
+        'api_latency_threshold': 30.,
     }
 
     _sql_constraints = [
@@ -170,6 +222,23 @@ class magento_backend(orm.Model):
          "A backend with the same sale prefix already exists")
     ]
 
+    # fields of the backend kept in its BackendConfig
+    _config_fields = set(BackendConfig._fields).union(
+        ['default_lang_id', 'product_stock_field_id'])
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(magento_backend, self).write(cr, uid, ids, vals,
+                                                 context=context)
+        # the jobs often write the dates of the last imports, which
+        # do not change the configuration
+        if self._config_fields.intersection(vals):
+            if not hasattr(ids, '__iter__'):
+                ids = [ids]
+            cr.execute("UPDATE magento_backend "
+                       "SET config_revision = config_revision + 1 "
+                       "WHERE id IN %s", (tuple(ids),))
+        return res
+
     def check_magento_structure(self, cr, uid, ids, context=None):
         """ Used in each data import.
 
@@ -610,6 +679,11 @@ class MetadataBatchImport(DirectBatchImport):
         'magento.storeview',
     ]
 
+    def run(self, filters=None):
+        super(MetadataBatchImport, self).run(filters=filters)
+        # the websites and storeviews are part of the configuration
+        reset_backend_config(self.session)
+
 
 @magento
 class WebsiteImportMapper(ImportMapper):
@@ -19,9 +19,11 @@
 #
 ##############################################################################
 
+import hashlib
 import logging
 import xmlrpclib
 from collections import namedtuple
+from openerp import SUPERUSER_ID
 from openerp.osv import fields, orm
 from openerp.addons.connector.queue.job import job
 from openerp.addons.connector.connector import ConnectorUnit
@@ -36,6 +38,7 @@ from .unit.backend_adapter import GenericAdapter
 from .unit.import_synchronizer import (DelayedBatchImport,
                                        MagentoImportSynchronizer
                                        )
+from .unit.worker_cache import WorkerCache
 from .backend import magento
 from .connector import get_environment
 
@@ -73,6 +76,11 @@ class res_partner(orm.Model):
         return fields
 
 
+def normalize_email(email):
+    """ Normalized form of an e-mail, used to match the partners """
+    return (email or '').strip().lower() or False
+
+
 class magento_res_partner(orm.Model):
     _name = 'magento.res.partner'
     _inherit = 'magento.binding'
@@ -86,6 +94,12 @@ class magento_res_partner(orm.Model):
         return mag_partner_obj.search(
             cr, uid, [('website_id', 'in', ids)], context=context)
 
+    def _get_email_normalized(self, cr, uid, ids, name, arg, context=None):
+        res = {}
+        for partner in self.read(cr, uid, ids, ['emailid'], context=context):
+            res[partner['id']] = normalize_email(partner['emailid'])
+        return res
+
     _columns = {
         'openerp_id': fields.many2one('res.partner',
                                       string='Partner',
@@ -114,6 +128,16 @@ class magento_res_partner(orm.Model):
         'updated_at': fields.datetime('Updated At (on Magento)',
                                       readonly=True),
         'emailid': fields.char('E-mail address'),
+        'email_normalized': fields.function(
+            _get_email_normalized,
+            type='char',
+            string='Normalized E-mail',
+            store={
+                'magento.res.partner': (lambda self, cr, uid, ids, c=None: ids,
+                                        ['emailid'], 10),
+            },
+            select=True,
+            readonly=True),
         'taxvat': fields.char('Magento VAT'),
         'newsletter': fields.boolean('Newsletter'),
         'guest_customer': fields.boolean('Guest Customer'),
@@ -130,6 +154,61 @@ class magento_res_partner(orm.Model):
          'A partner with same ID on Magento already exists for this website.'),
     ]
 
+    def find_by_email(self, cr, uid, website_id, email, context=None):
+        """ Find the partner of a website having an e-mail
+
+        The registered customers are preferred to the guest customers.
+
+        :param website_id: id of the ``magento.website``
+        :return: dict with the ``id``, ``magento_id`` and
+                 ``guest_customer`` of the binding, None when no partner
+                 has this e-mail
+        """
+        email = normalize_email(email)
+        if not email:
+            return None
+        binding_ids = self.search(cr, uid,
+                                  [('email_normalized', '=', email),
+                                   ('website_id', '=', website_id)],
+                                  order='id',
+                                  context=context)
+        if not binding_ids:
+            return None
+        bindings = self.read(cr, uid, binding_ids,
+                             ['magento_id', 'guest_customer'],
+                             context=context)
+        for binding in bindings:
+            if not binding['guest_customer']:
+                return binding
+        return bindings[0]
+
+
+# Fields identifying an address, see ``address_fingerprint``
+ADDRESS_FINGERPRINT_FIELDS = ('name', 'company', 'street', 'street2', 'zip',
+                              'city', 'state_id', 'country_id', 'phone',
+                              'fax', 'email')
+
+
+def address_fingerprint(values):
+    """ Fingerprint of the normalized fields of an address
+
+    Two addresses with the same fingerprint are considered the same.
+
+    :param values: values of the address, the many2one fields are
+                   either ids or tuples (id, name)
+    """
+    key = []
+    for field in ADDRESS_FINGERPRINT_FIELDS:
+        value = values.get(field)
+        if isinstance(value, (tuple, list)):
+            value = value[0]
+        elif isinstance(value, basestring):
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+            value = u' '.join(value.lower().split())
+        key.append(value or False)
+    return hashlib.sha1(repr(tuple(key))).hexdigest()
+
 
 class magento_address(orm.Model):
     _name = 'magento.address'
@@ -144,6 +223,22 @@ class magento_address(orm.Model):
         return mag_address_obj.search(
             cr, uid, [('magento_partner_id', 'in', ids)], context=context)
 
+    def _get_mag_address_from_openerp_partner(self, cr, uid, ids,
+                                              context=None):
+        mag_address_obj = self.pool['magento.address']
+        return mag_address_obj.search(
+            cr, uid, [('openerp_id', 'in', ids),
+                      '|', ('active', '=', True), ('active', '=', False)],
+            context=context)
+
+    def _get_fingerprint(self, cr, uid, ids, name, arg, context=None):
+        res = {}
+        for address in self.read(cr, uid, ids,
+                                 list(ADDRESS_FINGERPRINT_FIELDS),
+                                 context=context):
+            res[address['id']] = address_fingerprint(address)
+        return res
+
     _columns = {
         'openerp_id': fields.many2one('res.partner',
                                       string='Partner',
@@ -185,6 +280,21 @@ class magento_address(orm.Model):
             readonly=True),
         'is_magento_order_address': fields.boolean(
             'Address from a Magento Order'),
+        'address_fingerprint': fields.function(
+            _get_fingerprint,
+            type='char',
+            size=40,
+            string='Address Fingerprint',
+            store={
+                'magento.address': (lambda self, cr, uid, ids, c=None: ids,
+                                    ['openerp_id'], 10),
+                'res.partner': (_get_mag_address_from_openerp_partner,
+                                list(ADDRESS_FINGERPRINT_FIELDS), 20),
+            },
+            select=True,
+            readonly=True,
+            help="Identify the identical addresses, used to reuse the "
+                 "addresses of the previous orders of a customer"),
     }
 
     _sql_constraints = [
@@ -192,12 +302,117 @@ class magento_address(orm.Model):
          'A partner address with same ID on Magento already exists.'),
     ]
 
+    def find_order_address(self, cr, uid, partner_id, values, context=None):
+        """ Find an address of a previous order of a partner identical
+        to ``values``
+
+        :param partner_id: id of the parent ``res.partner``
+        :param values: values of the address
+        :return: id of the address (``res.partner``), None if there is
+                 no identical address
+        """
+        address_ids = self.search(
+            cr, uid,
+            [('parent_id', '=', partner_id),
+             ('is_magento_order_address', '=', True),
+             ('address_fingerprint', '=', address_fingerprint(values)),
+             '|', ('active', '=', True), ('active', '=', False)],
+            limit=1,
+            context=context)
+        if not address_ids:
+            return None
+        address = self.read(cr, uid, address_ids[0], ['openerp_id'],
+                            context=context)
+        return address['openerp_id'][0]
+
+
+# Countries, states and titles used to map the addresses, per database
+# and language
+_address_cache = WorkerCache()
+
+AddressLookup = namedtuple('AddressLookup', 'countries states titles')
+""" Lookup tables of a database: ``countries`` maps the codes to the
+ids, ``states`` maps the lowercase names to the ids and ``titles`` is a
+list of tuples (lowercase shortcut, id) of the contact titles, in the
+language of the context. """
+
+
+def _address_lookup_version(cr):
+    """ Version of the lookup tables of the addresses, changed when a
+    country, state, title or translation of a title is modified """
+    cr.execute("SELECT (SELECT max(write_date) FROM res_country), "
+               "       (SELECT count(*) FROM res_country), "
+               "       (SELECT max(write_date) FROM res_country_state), "
+               "       (SELECT count(*) FROM res_country_state), "
+               "       (SELECT max(write_date) FROM res_partner_title), "
+               "       (SELECT count(*) FROM res_partner_title), "
+               "       (SELECT max(write_date) FROM ir_translation "
+               "        WHERE name = 'res.partner.title,shortcut') ")
+    return cr.fetchone()
+
+
+def _load_address_lookup(pool, cr, context=None):
+    """ Read the lookup tables of the addresses """
+    countries = {}
+    country_obj = pool['res.country']
+    country_ids = country_obj.search(cr, SUPERUSER_ID, [], context=context)
+    for country in country_obj.read(cr, SUPERUSER_ID, country_ids,
+                                    ['code'], context=context):
+        if country['code']:
+            countries.setdefault(country['code'], country['id'])
+    states = {}
+    state_obj = pool['res.country.state']
+    state_ids = state_obj.search(cr, SUPERUSER_ID, [], context=context)
+    for state in state_obj.read(cr, SUPERUSER_ID, state_ids, ['name'],
+                                context=context):
+        states.setdefault(state['name'].lower(), state['id'])
+    title_obj = pool['res.partner.title']
+    title_ids = title_obj.search(cr, SUPERUSER_ID,
+                                 [('domain', '=', 'contact')],
+                                 context=context)
+    titles = [(title['shortcut'].lower(), title['id']) for title
+              in title_obj.read(cr, SUPERUSER_ID, title_ids,
+                                ['shortcut'], context=context)
+              if title['shortcut']]
+    return AddressLookup(countries, states, titles)
+
+
+def address_lookup(session):
+    """ Return the cached :class:`AddressLookup` of the database, in the
+    language of the session
+
+    The version of the cached lookup is checked once per session, so
+    once per job (see :func:`reset_address_lookup`).
+    """
+    lookups = getattr(session, '_magento_address_lookups', None)
+    if lookups is None:
+        lookups = session._magento_address_lookups = {}
+    cr = session.cr
+    lang = (session.context or {}).get('lang')
+    if lang not in lookups:
+        context = {'lang': lang} if lang else {}
+
+        def compute():
+            return _load_address_lookup(session.pool, cr, context=context)
+
+        lookups[lang] = _address_cache.get(
+            (cr.dbname, lang), compute,
+            version=_address_lookup_version(cr))
+    return lookups[lang]
+
+
+def reset_address_lookup(session):
+    """ Check again the version of the lookup on the next access, when
+    a country, state or title has been modified in the session """
+    session._magento_address_lookups = {}
+
 
 @magento
 class PartnerAdapter(GenericAdapter):
     _model_name = 'magento.res.partner'
     _magento_model = 'customer'
     _admin_path = '/{model}/edit/id/{id}'
+    _id_field = 'entity_id'
 
     def _call(self, method, arguments):
         try:
@@ -238,18 +453,19 @@ class PartnerBatchImport(DelayedBatchImport):
     For every partner in the list, a delayed job is created.
     """
     _model_name = ['magento.res.partner']
+    _chunk_size_field = 'import_partners_chunk_size'
 
     def run(self, filters=None):
         """ Run the synchronization """
         from_date = filters.pop('from_date', None)
         magento_website_ids = [filters.pop('magento_website_id')]
-        record_ids = self.backend_adapter.search(filters,
-                                                 from_date,
-                                                 magento_website_ids)
-        _logger.info('search for magento partners %s returned %s',
-                     filters, record_ids)
-        for record_id in record_ids:
-            self._import_record(record_id)
+        record_ids = self.backend_adapter.iter_search(
+            filters,
+            from_date=from_date,
+            magento_website_ids=magento_website_ids)
+        count = self._import_records(record_ids)
+        _logger.info('search for magento partners %s returned %d records',
+                     filters, count)
 
 
 @magento
@@ -420,8 +636,12 @@ class PartnerAddressBook(ConnectorUnit):
                                           {'eq': magento_partner_id}})
         if not mag_address_ids:
             return
-        for address_id in mag_address_ids:
-            magento_record = adapter.read(address_id)
+        # read all the addresses in multiCall requests
+        batch = adapter.batch()
+        reads = [(address_id, batch.add(adapter.read, address_id))
+                 for address_id in mag_address_ids]
+        for address_id, read in reads:
+            magento_record = read.result()
 
             # defines if the billing address is merged with the partner
             # or imported as a standalone contact
@@ -468,20 +688,19 @@ class BaseAddressImportMapper(ImportMapper):
     def state(self, record):
         if not record.get('region'):
             return
-        state_ids = self.session.search('res.country.state',
-                                        [('name', '=ilike', record['region'])])
-        if state_ids:
-            return {'state_id': state_ids[0]}
+        lookup = address_lookup(self.session)
+        state_id = lookup.states.get(record['region'].lower())
+        if state_id:
+            return {'state_id': state_id}
 
     @mapping
     def country(self, record):
         if not record.get('country_id'):
             return
-        country_ids = self.session.search(
-            'res.country',
-            [('code', '=', record['country_id'])])
-        if country_ids:
-            return {'country_id': country_ids[0]}
+        lookup = address_lookup(self.session)
+        country_id = lookup.countries.get(record['country_id'])
+        if country_id:
+            return {'country_id': country_id}
 
     @mapping
     def street(self, record):
@@ -500,9 +719,9 @@ class BaseAddressImportMapper(ImportMapper):
         prefix = record['prefix']
         title_id = False
         if prefix:
-            title_ids = self.session.search('res.partner.title',
-                                            [('domain', '=', 'contact'),
-                                             ('shortcut', 'ilike', prefix)])
+            lookup = address_lookup(self.session)
+            title_ids = [cached_id for shortcut, cached_id in lookup.titles
+                         if prefix.lower() in shortcut]
             if title_ids:
                 title_id = title_ids[0]
             else:
@@ -510,6 +729,7 @@ class BaseAddressImportMapper(ImportMapper):
                                                {'domain': 'contact',
                                                 'shortcut': prefix,
                                                 'name': prefix})
+                reset_address_lookup(self.session)
         return {'title': title_id}
 
 
@@ -21,14 +21,15 @@
 ##############################################################################
 
 import logging
-import urllib2
 import base64
+import hashlib
 import xmlrpclib
 import sys
 from openerp.osv import orm, fields
 from openerp.tools.translate import _
 from openerp.addons.connector.queue.job import job, related_action
 from openerp.addons.connector.event import on_record_write
+from openerp.addons.connector.session import ConnectorSession
 from openerp.addons.connector.unit.synchronizer import (ImportSynchronizer,
                                                         ExportSynchronizer
                                                         )
@@ -40,18 +41,28 @@ from openerp.addons.connector.unit.mapper import (mapping,
                                                   ImportMapper,
                                                   )
 from .unit.backend_adapter import GenericAdapter
+from .unit.image_downloader import image_downloader
 from .unit.mapper import normalize_datetime
 from .unit.import_synchronizer import (DelayedBatchImport,
                                        MagentoImportSynchronizer,
-                                       TranslationImporter,
                                        AddCheckpoint,
+                                       find_or_create,
                                        )
-from .connector import get_environment
+from .connector import get_environment, get_backend_config
 from .backend import magento
-from .related_action import unwrap_binding
+from .related_action import unwrap_binding, link
 
 _logger = logging.getLogger(__name__)
 
+# Number of products for which the inventory is exported by one job
+# when the quantities are recomputed
+INVENTORY_EXPORT_CHUNK_SIZE = 500
+# Number of products for which the quantities are read together
+RECOMPUTE_QTY_CHUNK_SIZE = 1000
+# Priority of the jobs importing the images of the products, lower
+# than the imports of the records (10) and of the translations (15)
+IMAGE_IMPORT_PRIORITY = 20
+
 
 class magento_product_product(orm.Model):
     _name = 'magento.product.product'
@@ -109,6 +120,10 @@ class magento_product_product(orm.Model):
             required=False,
             help="Check this to exclude the product "
                  "from stock synchronizations."),
+        'magento_image_id': fields.many2one('magento.product.image',
+                                            string='Magento Image',
+                                            readonly=True,
+                                            ondelete='set null'),
         }
 
     _defaults = {
@@ -124,35 +139,194 @@ class magento_product_product(orm.Model):
     ]
 
     def recompute_magento_qty(self, cr, uid, ids, context=None):
+        """ Recompute the quantities to send to Magento.
+
+        The products are grouped by stock location and stock field, the
+        quantities of a group are read together and the products having
+        the same new quantity are written together.
+
+        The quantities which changed are exported by a few jobs
+        per backend (see :func:`export_product_inventory_batch`)
+        instead of a job per product.
+        """
+        if context is None:
+            context = {}
         if not hasattr(ids, '__iter__'):
             ids = [ids]
 
-        for product in self.browse(cr, uid, ids, context=context):
-            new_qty = self._magento_qty(cr, uid, product, context=context)
-            if new_qty != product.magento_qty:
-                self.write(cr, uid, product.id,
-                           {'magento_qty': new_qty},
-                           context=context)
+        # the export of the quantities is done below
+        write_ctx = dict(context, magento_inventory_batch_export=True)
+        changed_ids = {}
+        groups = self._group_by_stock(cr, uid, ids, context=context)
+        for (location_id, stock_field), group_ids in groups.iteritems():
+            chunk_size = RECOMPUTE_QTY_CHUNK_SIZE
+            for index in xrange(0, len(group_ids), chunk_size):
+                chunk_ids = group_ids[index:index + chunk_size]
+                qties = self._magento_qties(cr, uid, chunk_ids,
+                                            location_id, stock_field,
+                                            context=context)
+                rows = self.read(cr, uid, chunk_ids,
+                                 ['magento_qty', 'no_stock_sync',
+                                  'backend_id'],
+                                 context=context,
+                                 load='_classic_write')
+                ids_by_qty = {}
+                for row in rows:
+                    new_qty = qties[row['id']]
+                    if new_qty == row['magento_qty']:
+                        continue
+                    ids_by_qty.setdefault(new_qty, []).append(row['id'])
+                    if not row['no_stock_sync']:
+                        backend_ids = changed_ids.setdefault(
+                            row['backend_id'], [])
+                        backend_ids.append(row['id'])
+                for new_qty, qty_ids in ids_by_qty.iteritems():
+                    self.write(cr, uid, qty_ids,
+                               {'magento_qty': new_qty},
+                               context=write_ctx)
+        if not context.get('connector_no_export'):
+            self._export_inventory_batch(cr, uid, changed_ids,
+                                         context=context)
         return True
 
-    def _magento_qty(self, cr, uid, product, context=None):
+    def _group_by_stock(self, cr, uid, ids, context=None):
+        """ Group the products by the stock location and the stock field
+        used to compute their quantity
+
+        :return: {(location_id, stock_field): [binding ids]}
+        :rtype: dict
+        """
+        rows = self.read(cr, uid, ids, ['backend_id'],
+                         context=context, load='_classic_write')
+        ids_by_backend = {}
+        for row in rows:
+            ids_by_backend.setdefault(row['backend_id'], []).append(row['id'])
+        session = ConnectorSession(cr, uid, context=context)
+        groups = {}
+        for backend_id, binding_ids in ids_by_backend.iteritems():
+            key = self._stock_location_and_field(session, backend_id)
+            groups.setdefault(key, []).extend(binding_ids)
+        return groups
+
+    def _stock_location_and_field(self, session, backend_id):
+        """ Return the stock location and the stock field used to compute
+        the quantities of the products of a backend """
+        config = get_backend_config(session, backend_id)
+        return config.stock_location_id, config.stock_field
+
+    def _magento_qties(self, cr, uid, ids, location_id, stock_field,
+                       context=None):
+        """ Return the quantities to send to Magento for products
+        sharing the same stock location and stock field
+
+        This is the method to override to change the quantities.  The
+        overrides of :meth:`_magento_qty` are still applied, but they
+        compute the quantities product by product.
+
+        :return: {binding id: quantity}
+        :rtype: dict
+        """
         if context is None:
             context = {}
-        backend = product.backend_id
-        stock = backend.warehouse_id.lot_stock_id
+        base_qty = magento_product_product._magento_qty.im_func
+        if self._magento_qty.im_func is not base_qty:
+            return dict((product.id,
+                         self._magento_qty(cr, uid, product,
+                                           context=context))
+                        for product in self.browse(cr, uid, ids,
+                                                   context=context))
+        location_ctx = dict(context, location=location_id)
+        rows = self.read(cr, uid, ids, [stock_field], context=location_ctx)
+        return dict((row['id'], row[stock_field]) for row in rows)
 
-        if backend.product_stock_field_id:
-            stock_field = backend.product_stock_field_id.name
-        else:
-            stock_field = 'virtual_available'
+    def _magento_qty(self, cr, uid, product, context=None):
+        """ Return the quantity to send to Magento for a product
 
+        Prefer to override :meth:`_magento_qties`.
+        """
+        if context is None:
+            context = {}
+        session = ConnectorSession(cr, uid, context=context)
+        location_id, stock_field = self._stock_location_and_field(
+            session, product.backend_id.id)
         location_ctx = context.copy()
-        location_ctx['location'] = stock.id
+        location_ctx['location'] = location_id
         product_stk = self.read(cr, uid, product.id,
                                 [stock_field],
                                 context=location_ctx)
         return product_stk[stock_field]
 
+    def _export_inventory_batch(self, cr, uid, ids_by_backend,
+                                context=None):
+        """ Delay the export of the quantities, by chunks of products
+
+        :param ids_by_backend: ids of the products for each backend
+        :type ids_by_backend: dict
+        """
+        session = ConnectorSession(cr, uid, context=context)
+        chunk_size = INVENTORY_EXPORT_CHUNK_SIZE
+        for backend_id, binding_ids in ids_by_backend.iteritems():
+            for index in xrange(0, len(binding_ids), chunk_size):
+                export_product_inventory_batch.delay(
+                    session, self._name, backend_id,
+                    binding_ids[index:index + chunk_size],
+                    fields=['magento_qty'], priority=20)
+
+
+class magento_product_image(orm.Model):
+    """ Images downloaded from Magento, known once per content.
+
+    The images are identified by the SHA-1 digest of their content, they
+    are shared by the product bindings of all the backends.  The content
+    is not copied here, it is the image of the products referencing the
+    record.  The URL which gave the image the last time is kept with its
+    ``ETag`` and ``Last-Modified`` headers so the next downloads of the
+    URL are conditional.
+    """
+    _name = 'magento.product.image'
+    _description = 'Magento Product Image'
+    _rec_name = 'digest'
+
+    _columns = {
+        'digest': fields.char('SHA-1 Digest', size=40, required=True,
+                              readonly=True, select=True),
+        'url': fields.char('URL', readonly=True, select=True),
+        'etag': fields.char('ETag', readonly=True),
+        'last_modified': fields.char('Last Modified', readonly=True),
+        'binding_ids': fields.one2many('magento.product.product',
+                                       'magento_image_id',
+                                       string='Magento Products',
+                                       readonly=True),
+    }
+
+    _sql_constraints = [
+        ('digest_uniq', 'unique(digest)',
+         "An image with the same digest already exists")
+    ]
+
+    def garbage_collect(self, cr, uid, ids=None, context=None):
+        """ Delete the images no longer used by a product binding.
+
+        :param ids: images to check, all the images when None
+        """
+        query = ("SELECT i.id FROM magento_product_image i "
+                 "WHERE NOT EXISTS (SELECT 1 FROM magento_product_product p "
+                 "                  WHERE p.magento_image_id = i.id) ")
+        params = ()
+        if ids is not None:
+            if not ids:
+                return True
+            query += "AND i.id IN %s"
+            params = (tuple(ids),)
+        cr.execute(query, params)
+        unused_ids = [row[0] for row in cr.fetchall()]
+        if unused_ids:
+            self.unlink(cr, uid, unused_ids, context=context)
+        return True
+
+    def _scheduler_garbage_collect(self, cr, uid, context=None):
+        self.garbage_collect(cr, uid, context=context)
+
 
 class product_product(orm.Model):
     _inherit = 'product.product'
@@ -178,6 +352,7 @@ class ProductProductAdapter(GenericAdapter):
     _model_name = 'magento.product.product'
     _magento_model = 'catalog_product'
     _admin_path = '/{model}/edit/id/{id}'
+    _id_field = 'entity_id'
 
     def _call(self, method, arguments):
         try:
@@ -242,15 +417,16 @@ class ProductBatchImport(DelayedBatchImport):
     Import from a date
     """
     _model_name = ['magento.product.product']
+    _chunk_size_field = 'import_products_chunk_size'
 
     def run(self, filters=None):
         """ Run the synchronization """
         from_date = filters.pop('from_date', None)
-        record_ids = self.backend_adapter.search(filters, from_date)
-        _logger.info('search for magento products %s returned %s',
-                     filters, record_ids)
-        for record_id in record_ids:
-            self._import_record(record_id)
+        record_ids = self.backend_adapter.iter_search(filters,
+                                                      from_date=from_date)
+        count = self._import_records(record_ids)
+        _logger.info('search for magento products %s returned %d records',
+                     filters, count)
 
 
 @magento
@@ -290,42 +466,135 @@ class CatalogImageImporter(ImportSynchronizer):
             return (primary, -position)
         return sorted(images, key=priority)
 
-    def _get_binary_image(self, image_data):
-        url = image_data['url'].encode('utf8')
-        try:
-            request = urllib2.Request(url)
-            if self.backend_record.auth_basic_username \
-                    and self.backend_record.auth_basic_password:
-                base64string = base64.encodestring(
-                    '%s:%s' % (self.backend_record.auth_basic_username,
-                               self.backend_record.auth_basic_password))
-                request.add_header("Authorization", "Basic %s" % base64string)
-            binary = urllib2.urlopen(request)
-        except urllib2.HTTPError as err:
-            if err.code == 404:
-                # the image is just missing, we skip it
-                return
-            else:
-                # we don't know why we couldn't download the image
-                # so we propagate the error, the import will fail
-                # and we have to check why it couldn't be accessed
-                raise
-        else:
-            return binary.read()
+    def _download_headers(self):
+        headers = {}
+        if self.backend_record.auth_basic_username \
+                and self.backend_record.auth_basic_password:
+            base64string = base64.b64encode(
+                '%s:%s' % (self.backend_record.auth_basic_username,
+                           self.backend_record.auth_basic_password))
+            headers['Authorization'] = "Basic %s" % base64string
+        return headers
+
+    def _get_stored_image(self, url):
+        """ Return the stored image downloaded the last time from the url
+
+        Only the images still used by a product are returned, the
+        content of an image is the image of its products.
+
+        :rtype: browse_record | None
+        """
+        image_ids = self.session.search('magento.product.image',
+                                        [('url', '=', url),
+                                         ('binding_ids', '!=', False)])
+        if not image_ids:
+            return None
+        return self.session.browse('magento.product.image', max(image_ids))
+
+    def _download_image(self, url, stored_image=None):
+        """ Download an image, only if it changed since it has been
+        stored.
+
+        Returns None when the image is missing (404), other HTTP errors
+        are propagated, the import will fail and we have to check why
+        it couldn't be accessed.
+
+        :rtype: :class:`~.unit.image_downloader.ImageResponse`
+        """
+        etag = last_modified = None
+        if stored_image is not None:
+            etag = stored_image.etag
+            last_modified = stored_image.last_modified
+        return image_downloader.download(url.encode('utf8'),
+                                         headers=self._download_headers(),
+                                         etag=etag,
+                                         last_modified=last_modified)
+
+    def _stored_image_data(self, stored_image):
+        """ Return the content of a stored image, base64 encoded
+
+        The content is the image of a product using the stored image,
+        provided that it has not been changed since.
+
+        :return: the content, None when no product has it anymore
+        """
+        for binding in stored_image.binding_ids:
+            if not binding.image:
+                continue
+            data = base64.b64decode(binding.image)
+            if hashlib.sha1(data).hexdigest() == stored_image.digest:
+                return binding.image
+        return None
+
+    def _store_image(self, url, response):
+        """ Store a downloaded image, once per content
+
+        :return: id of the ``magento.product.image``
+        """
+        image_model = 'magento.product.image'
+        digest = hashlib.sha1(response.data).hexdigest()
+        vals = {'url': url,
+                'etag': response.etag or False,
+                'last_modified': response.last_modified or False,
+                }
+        # the url gives now another content
+        previous_ids = self.session.search(image_model,
+                                           [('url', '=', url),
+                                            ('digest', '!=', digest)])
+        if previous_ids:
+            self.session.write(image_model, previous_ids,
+                               {'url': False,
+                                'etag': False,
+                                'last_modified': False})
+        session = self.session
+        image_id = find_or_create(session.cr, session.uid,
+                                  session.pool[image_model],
+                                  [('digest', '=', digest)],
+                                  dict(vals, digest=digest),
+                                  context=session.context)
+        self.session.write(image_model, image_id, vals)
+        return image_id
 
     def run(self, magento_id, binding_id):
         self.magento_id = magento_id
         images = self._get_images()
         images = self._sort_images(images)
-        binary = None
-        while not binary and images:
-            binary = self._get_binary_image(images.pop())
-        if not binary:
+        binding = self.session.browse(self.model._name, binding_id)
+        current_image_id = binding.magento_image_id.id
+        # the last images have the higher priority
+        for image_data in reversed(images or []):
+            url = image_data['url']
+            stored_image = self._get_stored_image(url)
+            response = self._download_image(url, stored_image=stored_image)
+            if response and response.not_modified:
+                data = self._stored_image_data(stored_image)
+                if data is not None:
+                    image_id = stored_image.id
+                    break
+                # the content is no longer available, download it again
+                response = self._download_image(url)
+            if not response:
+                continue
+            if response.data:
+                image_id = self._store_image(url, response)
+                data = base64.b64encode(response.data)
+                break
+        else:
+            return
+        if image_id == current_image_id:
+            # same content, no need to write it and compute the
+            # thumbnails again
             return
         with self.session.change_context({'connector_no_export': True}):
             self.session.write(self.model._name,
                                binding_id,
-                               {'image': base64.b64encode(binary)})
+                               {'image': data,
+                                'magento_image_id': image_id})
+        if current_image_id:
+            image_obj = self.session.pool['magento.product.image']
+            image_obj.garbage_collect(self.session.cr, self.session.uid,
+                                      [current_image_id],
+                                      context=self.session.context)
 
 
 @magento
@@ -396,14 +665,21 @@ class ProductImport(MagentoImportSynchronizer):
         return openerp_binding_id
 
     def _after_import(self, binding_id):
-        """ Hook called at the end of the import """
-        translation_importer = self.get_connector_unit_for_model(
-            TranslationImporter, self.model._name)
-        translation_importer.run(self.magento_id, binding_id,
-                                 mapper_class=ProductImportMapper)
-        image_importer = self.get_connector_unit_for_model(
-            CatalogImageImporter, self.model._name)
-        image_importer.run(self.magento_id, binding_id)
+        """ Hook called at the end of the import
+
+        The translations and the images are imported by their own
+        jobs, with a lower priority, so the product is committed without
+        waiting for them (for instance when it is imported by a sales
+        order).
+        """
+        self._import_translations(binding_id,
+                                  mapper_class=ProductImportMapper)
+        import_product_images.delay(self.session,
+                                    self.model._name,
+                                    self.backend_record.id,
+                                    self.magento_id,
+                                    binding_id,
+                                    priority=IMAGE_IMPORT_PRIORITY)
 
 
 @magento
@@ -453,12 +729,10 @@ class ProductImportMapper(ImportMapper):
 
     @mapping
     def website_ids(self, record):
-        website_ids = []
         binder = self.get_binder_for_model('magento.website')
-        for mag_website_id in record['websites']:
-            website_id = binder.to_openerp(mag_website_id)
-            website_ids.append((4, website_id))
-        return {'website_ids': website_ids}
+        website_ids = binder.to_openerp_many(record['websites'])
+        return {'website_ids': [(4, website_id)
+                                for website_id in website_ids]}
 
     @mapping
     def categories(self, record):
@@ -468,8 +742,8 @@ class ProductImportMapper(ImportMapper):
         category_ids = []
         main_categ_id = None
 
-        for mag_category_id in mag_categories:
-            cat_id = binder.to_openerp(mag_category_id, unwrap=True)
+        cat_ids = binder.to_openerp_many(mag_categories, unwrap=True)
+        for mag_category_id, cat_id in zip(mag_categories, cat_ids):
             if cat_id is None:
                 raise MappingError("The product category with "
                                    "magento id %s is not imported." %
@@ -540,6 +814,52 @@ class ProductInventoryExport(ExportSynchronizer):
         self.backend_adapter.update_inventory(magento_id, data)
 
 
+@magento
+class ProductInventoryBatchExport(ExportSynchronizer):
+    """ Export the inventory of many products with ``multiCall`` """
+    _model_name = ['magento.product.product']
+
+    def run(self, binding_ids, fields):
+        """ Export the products inventory to Magento
+
+        A product which fails is exported again in its own job so its
+        error is reported on it.
+        """
+        inventory_exporter = self.get_connector_unit_for_model(
+            ProductInventoryExport)
+        binder = self.get_binder_for_model()
+        adapter = self.backend_adapter
+        batch = adapter.batch()
+        calls = []
+        for product in self.session.browse(self.model._name, binding_ids):
+            if product.no_stock_sync:
+                continue
+            magento_id = binder.to_backend(product.id)
+            data = inventory_exporter._get_data(product, fields)
+            calls.append((product.id,
+                          batch.add(adapter.update_inventory,
+                                    magento_id, data)))
+        batch.flush()
+        failed_ids = []
+        for binding_id, call in calls:
+            try:
+                call.result()
+            except (xmlrpclib.Fault, IDMissingInBackend):
+                _logger.warning('inventory export of product %s failed, '
+                                'exported again in a job',
+                                binding_id, exc_info=True)
+                failed_ids.append(binding_id)
+        for binding_id in failed_ids:
+            export_product_inventory.delay(self.session, self.model._name,
+                                           binding_id, fields=fields,
+                                           priority=20)
+        if failed_ids:
+            return _('%d inventories exported, %d failed and delayed '
+                     'in their own job') % (len(calls) - len(failed_ids),
+                                            len(failed_ids))
+        return _('%d inventories exported') % len(calls)
+
+
 # fields which should not trigger an export of the products
 # but an export of their inventory
 INVENTORY_FIELDS = ('manage_stock',
@@ -554,7 +874,11 @@ def magento_product_modified(session, model_name, record_id, vals):
         return
     if session.browse(model_name, record_id).no_stock_sync:
         return
-    inventory_fields = list(set(vals).intersection(INVENTORY_FIELDS))
+    inventory_fields = set(vals).intersection(INVENTORY_FIELDS)
+    if session.context.get('magento_inventory_batch_export'):
+        # the quantity is exported by export_product_inventory_batch
+        inventory_fields.discard('magento_qty')
+    inventory_fields = list(inventory_fields)
     if inventory_fields:
         export_product_inventory.delay(session, model_name,
                                        record_id, fields=inventory_fields,
@@ -570,3 +894,25 @@ def export_product_inventory(session, model_name, record_id, fields=None):
     env = get_environment(session, model_name, backend_id)
     inventory_exporter = env.get_connector_unit(ProductInventoryExport)
     return inventory_exporter.run(record_id, fields)
+
+
+@job
+def export_product_inventory_batch(session, model_name, backend_id,
+                                   record_ids, fields=None):
+    """ Export the inventory configuration and quantity of products. """
+    env = get_environment(session, model_name, backend_id)
+    inventory_exporter = env.get_connector_unit(ProductInventoryBatchExport)
+    return inventory_exporter.run(record_ids, fields)
+
+
+@job
+@related_action(action=link)
+def import_product_images(session, model_name, backend_id, magento_id,
+                          binding_id):
+    """ Import the image of a product from Magento """
+    model = session.pool[model_name]
+    if not model.exists(session.cr, session.uid, binding_id):
+        return _('Record does no longer exist in OpenERP')
+    env = get_environment(session, model_name, backend_id)
+    image_importer = env.get_connector_unit(CatalogImageImporter)
+    image_importer.run(magento_id, binding_id)
@@ -29,12 +29,14 @@ from openerp.addons.connector.exception import (IDMissingInBackend,
                                                 MappingError,
                                                 )
 from .unit.backend_adapter import GenericAdapter
+from openerp.addons.connector.queue.job import job
 from .unit.import_synchronizer import (DelayedBatchImport,
                                        MagentoImportSynchronizer,
-                                       TranslationImporter,
+                                       RecordChunkImport,
                                        AddCheckpoint,
                                        )
 from .backend import magento
+from .connector import get_environment
 
 _logger = logging.getLogger(__name__)
 
@@ -146,43 +148,127 @@ class ProductCategoryAdapter(GenericAdapter):
                           [parent_id, storeview_id])
         return filter_ids(tree)
 
+    def tree_nodes(self, parent_id=None, storeview_id=None):
+        """ Returns the nodes of the tree of product categories,
+        the parents before their children
+
+        :return: list of tuples (category id, parent id, level), the
+                 parent of the top node is None
+        :rtype: list
+        """
+        if parent_id:
+            parent_id = int(parent_id)
+        tree = self._call('%s.tree' % self._magento_model,
+                          [parent_id, storeview_id])
+        nodes = []
+        # breadth-first walk, iterative as the tree can be deep
+        level_nodes = [(tree, None)]
+        level = 0
+        while level_nodes:
+            next_nodes = []
+            for node, node_parent_id in level_nodes:
+                category_id = str(node['category_id'])
+                nodes.append((category_id, node_parent_id, level))
+                next_nodes += [(child, category_id)
+                               for child in node['children'] or []]
+            level_nodes = next_nodes
+            level += 1
+        return nodes
+
 
 @magento
 class ProductCategoryBatchImport(DelayedBatchImport):
     """ Import the Magento Product Categories.
 
-    For every product category in the list, a delayed job is created.
-    A priority is set on the jobs according to their level to rise the
-    chance to have the top level categories imported first.
+    The categories are imported level by level: the levels of the tree
+    are split in chunks of ``import_categories_chunk_size`` categories,
+    a job imports a chunk then delays the job importing the next one, so
+    the parent categories are always imported before their children.
     """
     _model_name = ['magento.product.category']
+    _chunk_size_field = 'import_categories_chunk_size'
 
-    def _import_record(self, magento_id, priority=None):
-        """ Delay a job for the import """
-        super(ProductCategoryBatchImport, self)._import_record(
-            magento_id, priority=priority)
+    def _import_levels(self, levels):
+        """ Delay the job importing the levels
+
+        :param levels: list of the levels of the tree, each level is
+                       the list of the ids of the categories to import
+        """
+        size = self._chunk_size()
+        chunks = [level[index:index + size] for level in levels
+                  for index in xrange(0, len(level), size)]
+        if chunks:
+            import_category_levels.delay(self.session,
+                                         self.model._name,
+                                         self.backend_record.id,
+                                         chunks)
+
+    def _imported_tree(self):
+        """ Return the structure of the tree of the categories as
+        imported in OpenERP
+
+        :return: dict {category id: parent id}, the parent of the top
+                 category is None
+        """
+        self.session.cr.execute(
+            "SELECT c.magento_id, p.magento_id "
+            "FROM magento_product_category c "
+            "LEFT JOIN magento_product_category p "
+            "ON p.id = c.magento_parent_id "
+            "WHERE c.backend_id = %s AND c.magento_id IS NOT NULL",
+            (self.backend_record.id,))
+        return dict(self.session.cr.fetchall())
+
+    def _changed_nodes(self, nodes, updated_ids):
+        """ Compare the tree of Magento with the one imported in OpenERP
+
+        :param nodes: nodes of the tree of Magento (see
+                      :meth:`ProductCategoryAdapter.tree_nodes`)
+        :param updated_ids: set of the ids of the categories modified
+                            on Magento
+        :return: set of the ids of the categories which are new, moved
+                 or modified
+        """
+        imported = self._imported_tree()
+        changed = set()
+        for category_id, parent_id, __ in nodes:
+            if category_id in updated_ids:
+                changed.add(category_id)
+            elif category_id not in imported:
+                changed.add(category_id)
+            elif imported[category_id] != parent_id:
+                changed.add(category_id)
+        removed = set(imported).difference(node[0] for node in nodes)
+        if removed:
+            _logger.info('Product categories %s have been removed from '
+                         'Magento', ', '.join(sorted(removed)))
+        return changed
 
     def run(self, filters=None):
-        """ Run the synchronization """
+        """ Run the synchronization
+
+        When a ``from_date`` is given, only the categories modified
+        since that date and the ones added or moved in the tree are
+        imported.
+        """
         from_date = filters.pop('from_date', None)
+        nodes = self.backend_adapter.tree_nodes()
         if from_date is not None:
-            updated_ids = self.backend_adapter.search(filters, from_date)
+            updated_ids = set(
+                str(category_id) for category_id
+                in self.backend_adapter.search(filters, from_date))
+            changed_ids = self._changed_nodes(nodes, updated_ids)
         else:
-            updated_ids = None
+            changed_ids = None
 
-        base_priority = 10
-
-        def import_nodes(tree, level=0):
-            for node_id, children in tree.iteritems():
-                # By changing the priority, the top level category has
-                # more chance to be imported before the childrens.
-                # However, importers have to ensure that their parent is
-                # there and import it if it doesn't exist
-                if updated_ids is None or node_id in updated_ids:
-                    self._import_record(node_id, priority=base_priority+level)
-                import_nodes(children, level=level+1)
-        tree = self.backend_adapter.tree()
-        import_nodes(tree)
+        levels = []
+        # the parents are before their children in the nodes
+        for category_id, __, level in nodes:
+            if changed_ids is None or category_id in changed_ids:
+                while len(levels) <= level:
+                    levels.append([])
+                levels[level].append(category_id)
+        self._import_levels([level for level in levels if level])
 
 
 @magento
@@ -190,7 +276,12 @@ class ProductCategoryImport(MagentoImportSynchronizer):
     _model_name = ['magento.product.category']
 
     def _import_dependencies(self):
-        """ Import the dependencies for the record"""
+        """ Import the dependencies for the record
+
+        The batch imports guarantee that the parent is imported first,
+        the parent is imported here only for the single imports or when
+        its import failed.
+        """
         record = self.magento_record
         env = self.environment
         # import parent category
@@ -210,9 +301,7 @@ class ProductCategoryImport(MagentoImportSynchronizer):
 
     def _after_import(self, binding_id):
         """ Hook called at the end of the import """
-        translation_importer = self.get_connector_unit_for_model(
-            TranslationImporter, self.model._name)
-        translation_importer.run(self.magento_id, binding_id)
+        self._import_translations(binding_id)
 
 
 @magento
@@ -251,3 +340,21 @@ class ProductCategoryImportMapper(ImportMapper):
                                "magento id %s is not imported." %
                                record['parent_id'])
         return {'parent_id': category_id, 'magento_parent_id': mag_cat_id}
+
+
+@job
+def import_category_levels(session, model_name, backend_id, levels,
+                           force=False):
+    """ Import the first chunk of categories and delay the import
+    of the next ones
+
+    :param levels: list of chunks of categories, the chunks of a level
+                   of the tree are before the ones of the next level
+    """
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(RecordChunkImport)
+    result = importer.run(levels[0], force=force)
+    if levels[1:]:
+        import_category_levels.delay(session, model_name, backend_id,
+                                     levels[1:], force=force)
+    return result
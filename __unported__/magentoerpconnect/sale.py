@@ -22,6 +22,7 @@
 import logging
 import xmlrpclib
 from datetime import datetime, timedelta
+from itertools import islice
 import openerp.addons.decimal_precision as dp
 from openerp.osv import fields, orm
 from openerp.tools.translate import _
@@ -60,6 +61,10 @@ ORDER_STATUS_MAPPING = {  # XXX check if still needed
     'waiting_date': 'holded'
 }
 
+# Number of sales orders read together by the batch import, the jobs
+# importing the orders receive their data
+ORDER_PREFETCH_CHUNK_SIZE = 50
+
 
 class magento_sale_order(orm.Model):
     _name = 'magento.sale.order'
@@ -214,6 +219,9 @@ class SaleOrderAdapter(GenericAdapter):
     _model_name = 'magento.sale.order'
     _magento_model = 'sales_order'
     _admin_path = '{model}/view/order_id/{id}'
+    # the ids returned by the search are the increment ids, the
+    # pagination is done on the internal ids
+    _id_field = 'entity_id'
 
     def _call(self, method, arguments):
         try:
@@ -258,15 +266,70 @@ class SaleOrderAdapter(GenericAdapter):
     def get_parent(self, id):
         return self._call('%s.get_parent' % self._magento_model, [id])
 
+    def read_status(self, id):
+        """ Returns the last update date and the status of a sales order,
+        lighter than :meth:`read`
+
+        :return: tuple (updated_at, status)
+        """
+        records = self._call('%s.list' % self._magento_model,
+                             [{'increment_id': {'eq': id}}])
+        if not records:
+            raise IDMissingInBackend
+        return records[0].get('updated_at'), records[0].get('status')
+
 
 @magento
 class SaleOrderBatchImport(DelayedBatchImport):
     _model_name = ['magento.sale.order']
 
-    def _import_record(self, record_id, **kwargs):
-        """ Import the record directly """
+    def _import_record(self, record_id, record=None, **kwargs):
+        """ Delay the import of the record
+
+        :param record: Magento data of the order, stored for the job so
+                       it does not read it again
+        """
         return super(SaleOrderBatchImport, self)._import_record(
-            record_id, max_retries=0, priority=5)
+            record_id, record=record, max_retries=0, priority=5)
+
+    def _prefetch(self, record_ids):
+        """ Read sales orders with ``multiCall`` requests
+
+        :return: dict {magento id: record}, the orders which could not
+                 be read are missing, their jobs will read them
+        """
+        adapter = self.backend_adapter
+        batch = adapter.batch()
+        reads = [(record_id, batch.add(adapter.read, record_id))
+                 for record_id in record_ids]
+        batch.flush()
+        records = {}
+        for record_id, read in reads:
+            try:
+                records[record_id] = read.result()
+            except (IDMissingInBackend, xmlrpclib.Fault):
+                continue
+        return records
+
+    def _import_records(self, record_ids):
+        """ Delay the import of the orders with their data
+
+        The orders are read by chunks when they are searched, so the
+        jobs do not have to read them.
+
+        :return: number of records
+        """
+        count = 0
+        record_ids = iter(record_ids)
+        while True:
+            chunk = list(islice(record_ids, ORDER_PREFETCH_CHUNK_SIZE))
+            if not chunk:
+                return count
+            records = self._prefetch(chunk)
+            for record_id in chunk:
+                self._import_record(record_id,
+                                    record=records.get(record_id))
+            count += len(chunk)
 
     def run(self, filters=None):
         """ Run the synchronization """
@@ -275,13 +338,13 @@ class SaleOrderBatchImport(DelayedBatchImport):
         filters['state'] = {'neq': 'canceled'}
         from_date = filters.pop('from_date', None)
         magento_storeview_ids = [filters.pop('magento_storeview_id')]
-        record_ids = self.backend_adapter.search(filters,
-                                                 from_date,
-                                                 magento_storeview_ids)
-        _logger.info('search for magento saleorders %s  returned %s',
-                     filters, record_ids)
-        for record_id in record_ids:
-            self._import_record(record_id)
+        record_ids = self.backend_adapter.iter_search(
+            filters,
+            from_date=from_date,
+            magento_storeview_ids=magento_storeview_ids)
+        count = self._import_records(record_ids)
+        _logger.info('search for magento saleorders %s returned %d records',
+                     filters, count)
 
 
 @magento
@@ -378,6 +441,17 @@ class SaleOrderImport(MagentoImportSynchronizer):
                 SaleOrderImportMapper)
         return self._mapper
 
+    def is_current(self, record):
+        """ The data read by the batch import are current when the order
+        has not been modified since """
+        try:
+            updated_at, status = self.backend_adapter.read_status(
+                record['increment_id'])
+        except IDMissingInBackend:
+            return False
+        return (updated_at == record.get('updated_at') and
+                status == record.get('status'))
+
     def _must_skip(self):
         """ Hook called right after we read the data from the backend.
 
@@ -463,7 +537,17 @@ class SaleOrderImport(MagentoImportSynchronizer):
 
     def _before_import(self):
         rules = self.get_connector_unit_for_model(SaleImportRule)
-        rules.check(self.magento_record)
+        try:
+            rules.check(self.magento_record)
+        except OrderImportRuleRetry:
+            if self.prefetched_record is None:
+                raise
+            # the data read when the order has been searched may be
+            # outdated (order paid since then, ...), check again with
+            # the current data
+            self.prefetched_record = None
+            self.magento_record = self._get_magento_data()
+            rules.check(self.magento_record)
 
     def _create_payment(self, binding_id):
         sess = self.session
@@ -495,6 +579,13 @@ class SaleOrderImport(MagentoImportSynchronizer):
         all_parent_ids = []
         while parent_id:
             all_parent_ids.append(parent_id)
+            parent_bind_id = self.binder.to_openerp(parent_id)
+            if parent_bind_id and self.session.read(
+                    self.model._name, parent_bind_id,
+                    ['magento_parent_id'])['magento_parent_id']:
+                # the older parents have been linked when this parent
+                # has been imported
+                break
             parent_id = self.backend_adapter.get_parent(parent_id)
         current_bind_id = binding_id
         for parent_id in all_parent_ids:
@@ -552,6 +643,7 @@ class SaleOrderImport(MagentoImportSynchronizer):
 
         # Magento allows to create a sale order not registered as a user
         is_guest_order = bool(int(record.get('customer_is_guest', 0) or 0))
+        guest_partner = None
 
         # For a guest order or when magento does not provide customer_id
         # on a non-guest order (it happens, Magento inconsistencies are
@@ -561,25 +653,24 @@ class SaleOrderImport(MagentoImportSynchronizer):
             oe_website_id = website_binder.to_openerp(record['website_id'])
 
             # search an existing partner with the same email
-            partner_ids = sess.search(
-                'magento.res.partner',
-                [('emailid', '=', record['customer_email']),
-                 ('website_id', '=', oe_website_id)])
+            partner = sess.pool['magento.res.partner'].find_by_email(
+                sess.cr, sess.uid, oe_website_id,
+                record['customer_email'], context=sess.context)
 
             # if we have found one, we "fix" the record with the magento
             # customer id
-            if partner_ids:
-                partner = sess.read('magento.res.partner',
-                                    partner_ids[0],
-                                    ['magento_id'])
+            if partner:
                 # If there are multiple orders with "customer_id is
                 # null" and "customer_is_guest = 0" which share the same
                 # customer_email, then we may get a magento_id that is a
                 # marker 'guestorder:...' for a guest order (which is
                 # set below).  This causes a problem with
                 # "importer.run..." below where the id is cast to int.
-                if str(partner['magento_id']).startswith('guestorder:'):
+                if (partner['guest_customer'] or
+                        str(partner['magento_id']).startswith('guestorder:')):
                     is_guest_order = True
+                    # the guest partner of a previous order is reused
+                    guest_partner = partner
                 else:
                     record['customer_id'] = partner['magento_id']
 
@@ -589,7 +680,12 @@ class SaleOrderImport(MagentoImportSynchronizer):
                 is_guest_order = True
 
         partner_binder = self.get_binder_for_model('magento.res.partner')
-        if is_guest_order:
+        if is_guest_order and guest_partner:
+            # ensure that the flag is correct in the record
+            record['customer_is_guest'] = True
+            record['customer_id'] = guest_partner['magento_id']
+            partner_bind_id = guest_partner['id']
+        elif is_guest_order:
             # ensure that the flag is correct in the record
             record['customer_is_guest'] = True
             guest_customer_id = 'guestorder:%s' % record['increment_id']
@@ -666,11 +762,19 @@ class SaleOrderImport(MagentoImportSynchronizer):
         addr_mapper = self.get_connector_unit_for_model(ImportMapper,
                                                         'magento.address')
 
+        address_obj = sess.pool['magento.address']
+
         def create_address(address_record):
             map_record = addr_mapper.map_record(address_record)
             map_record.update(addresses_defaults)
-            address_bind_id = sess.create('magento.address',
-                                          map_record.values(for_create=True))
+            values = map_record.values(for_create=True)
+            # the same addresses are used again by the next orders of
+            # the customer, they are not created again
+            address_id = address_obj.find_order_address(
+                sess.cr, sess.uid, partner_id, values, context=sess.context)
+            if address_id is not None:
+                return address_id
+            address_bind_id = sess.create('magento.address', values)
             return sess.read('magento.address',
                              address_bind_id,
                              ['openerp_id'])['openerp_id'][0]
@@ -723,11 +827,12 @@ class SaleOrderImport(MagentoImportSynchronizer):
 
         self._import_addresses()
 
-        for line in record.get('items', []):
-            _logger.debug('line: %s', line)
-            if 'product_id' in line:
-                self._import_dependency(line['product_id'],
-                                        'magento.product.product')
+        # the already imported products are found with one query,
+        # the missing ones are read in parallel before being imported
+        self._import_dependencies_many(
+            [line['product_id'] for line in record.get('items', [])
+             if 'product_id' in line],
+            'magento.product.product')
 
 
 @magento
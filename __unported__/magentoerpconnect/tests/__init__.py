@@ -24,9 +24,14 @@ import test_address_book
 import test_export_invoice
 import test_import_product_image
 import test_related_action
+import test_backend_adapter
+import test_export_coalescing
+import test_image_downloader
 
 
 fast_suite = [
+    test_backend_adapter,
+    test_image_downloader,
 ]
 
 checks = [
@@ -35,4 +40,5 @@ checks = [
     test_export_invoice,
     test_import_product_image,
     test_related_action,
+    test_export_coalescing,
 ]
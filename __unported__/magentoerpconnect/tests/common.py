@@ -25,7 +25,8 @@ Helpers usable in the tests
 
 import mock
 from contextlib import contextmanager
-from ..unit.backend_adapter import call_to_key
+from ..unit.backend_adapter import call_to_key, api_pool
+from ..unit.image_downloader import image_downloader
 
 
 class TestResponder(object):
@@ -58,6 +59,9 @@ class TestResponder(object):
             "%s not found in magento responses" % str(key))
         return self._responses[key]
 
+    def multi_call(self, calls):
+        return [self(method, arguments) for method, arguments in calls]
+
 
 @contextmanager
 def mock_api(responses, key_func=None):
@@ -66,30 +70,22 @@ def mock_api(responses, key_func=None):
     :type responses: dict
     """
     get_magento_response = TestResponder(responses, key_func=key_func)
+    # sessions opened with a previous mock must not be reused
+    api_pool.clear()
     with mock.patch('magento.API') as API:
         api_mock = mock.MagicMock(name='magento.api')
         API.return_value = api_mock
         api_mock.__enter__.return_value = api_mock
         api_mock.call.side_effect = get_magento_response
-        yield get_magento_response._calls
-
-
-class MockResponseImage(object):
-    def __init__(self, resp_data, code=200, msg='OK'):
-        self.resp_data = resp_data
-        self.code = code
-        self.msg = msg
-        self.headers = {'content-type': 'image/jpeg'}
-
-    def read(self):
-        return self.resp_data
-
-    def getcode(self):
-        return self.code
+        api_mock.multiCall.side_effect = get_magento_response.multi_call
+        try:
+            yield get_magento_response._calls
+        finally:
+            api_pool.clear()
 
 
 @contextmanager
 def mock_urlopen_image():
-    with mock.patch('urllib2.urlopen') as urlopen:
-        urlopen.return_value = MockResponseImage('')
+    with mock.patch.object(image_downloader, '_request') as request:
+        request.return_value = 200, 'OK', {}, ''
         yield
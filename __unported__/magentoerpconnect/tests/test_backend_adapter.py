@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import httplib
+import json
+import socket
+import xmlrpclib
+
+import mock
+import unittest2
+
+from openerp.addons.connector.exception import (IDMissingInBackend,
+                                                NetworkRetryableError)
+from openerp.addons.magentoerpconnect.unit.backend_adapter import (
+    MagentoAPIPool,
+    MagentoLocation,
+    SESSION_EXPIRED_FAULT,
+    api_pool,
+)
+from openerp.addons.magentoerpconnect.unit.api_stats import APIStats
+from openerp.addons.magentoerpconnect.exception import BackendUnavailable
+from openerp.addons.magentoerpconnect.unit.circuit_breaker import (
+    CircuitBreaker,
+    FAILURE_THRESHOLD,
+    RESET_TIMEOUT,
+)
+from openerp.addons.magentoerpconnect.unit.rate_limiter import (
+    BackendLimiter,
+    MIN_FACTOR,
+)
+from openerp.addons.magentoerpconnect.unit.import_synchronizer import (
+    json_default)
+from openerp.addons.magentoerpconnect.unit.worker_cache import WorkerCache
+from openerp.addons.magentoerpconnect.partner import PartnerAdapter
+
+
+class test_api_pool(unittest2.TestCase):
+    """ Test the pool of Magento API sessions """
+
+    def setUp(self):
+        super(test_api_pool, self).setUp()
+        self.pool = MagentoAPIPool()
+        self.location = MagentoLocation('http://anyurl', 'guewen', '42')
+        patcher = mock.patch('magento.API')
+        self.API = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.API.side_effect = lambda *a, **kw: mock.MagicMock()
+
+    def test_login(self):
+        """ A new session is logged in """
+        api = self.pool.acquire(self.location)
+        api.connect.assert_called_once_with()
+        api.client.login.assert_called_once_with('guewen', '42')
+        self.assertEqual(api.session, api.client.login.return_value)
+
+    def test_reuse_session(self):
+        """ A released session is reused by the next call """
+        self.pool.execute(self.location, lambda api: api.call('a', []))
+        self.pool.execute(self.location, lambda api: api.call('b', []))
+        self.assertEqual(self.API.call_count, 1)
+
+    def test_concurrent_sessions(self):
+        """ A session is used by only one caller at a time """
+        api1 = self.pool.acquire(self.location)
+        api2 = self.pool.acquire(self.location)
+        self.assertIsNot(api1, api2)
+        self.pool.release(self.location, api1)
+        self.assertIs(self.pool.acquire(self.location), api1)
+
+    def test_session_expired(self):
+        """ Login again when the session expired """
+        calls = []
+
+        def call(api):
+            calls.append(api)
+            if len(calls) == 1:
+                raise xmlrpclib.Fault(SESSION_EXPIRED_FAULT,
+                                      'Session expired. Try to relogin.')
+            return 'ok'
+        self.assertEqual(self.pool.execute(self.location, call), 'ok')
+        self.assertEqual(self.API.call_count, 2)
+        self.assertIsNot(calls[0], calls[1])
+        for api in calls:
+            api.client.login.assert_called_once_with('guewen', '42')
+
+    def test_network_error_drop_session(self):
+        """ A session which failed on a network error is not reused """
+        def call(api):
+            raise socket.error('connection reset')
+        with self.assertRaises(socket.error):
+            self.pool.execute(self.location, call)
+        self.pool.execute(self.location, lambda api: api.call('a', []))
+        self.assertEqual(self.API.call_count, 2)
+
+    def test_http_error_drop_session(self):
+        """ A session which failed on an HTTP error is not reused """
+        def call(api):
+            raise httplib.BadStatusLine('')
+        with self.assertRaises(httplib.HTTPException):
+            self.pool.execute(self.location, call)
+        self.pool.execute(self.location, lambda api: api.call('a', []))
+        self.assertEqual(self.API.call_count, 2)
+
+    def test_evict_idle(self):
+        """ Idle sessions are closed after the timeout """
+        self.pool.idle_timeout = -1
+        api = self.pool.acquire(self.location)
+        self.pool.release(self.location, api)
+        self.assertIsNot(self.pool.acquire(self.location), api)
+        api.__exit__.assert_called_once_with(None, None, None)
+
+
+class test_batch(unittest2.TestCase):
+    """ Test the grouping of calls in multiCall requests """
+
+    def setUp(self):
+        super(test_batch, self).setUp()
+        env = mock.MagicMock()
+        env.backend_config.location = 'http://anyurl'
+        env.backend_config.use_auth_basic = False
+        env.backend_config.api_max_concurrency = 0
+        env.backend_config.api_rate_limit = 0
+        self.adapter = PartnerAdapter(env)
+        api_pool.clear()
+        self.addCleanup(api_pool.clear)
+        patcher = mock.patch('magento.API')
+        API = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.api = API.return_value
+
+    def test_read_batch(self):
+        """ Read records in one multiCall, a fault concerns only 1 record """
+        self.api.multiCall.return_value = [
+            {'customer_id': '1', 'email': 'one@example.com'},
+            {'isFault': True, 'faultCode': '102',
+             'faultMessage': 'Customer not exists.'},
+        ]
+        batch = self.adapter.batch()
+        read1 = batch.add(self.adapter.read, 1)
+        read2 = batch.add(self.adapter.read, 2)
+        self.assertFalse(self.api.multiCall.called)
+        self.assertEqual(read1.result()['email'], 'one@example.com')
+        with self.assertRaises(IDMissingInBackend):
+            read2.result()
+        self.api.multiCall.assert_called_once_with(
+            [['customer.info', [1]], ['customer.info', [2]]])
+        self.assertFalse(self.api.call.called)
+
+    def test_batch_size(self):
+        """ A multiCall is sent each time the size is reached """
+        self.api.multiCall.side_effect = lambda calls: [True] * len(calls)
+        batch = self.adapter.batch(size=2)
+        for magento_id in range(5):
+            batch.add(self.adapter.write, magento_id, {'email': 'a@b.c'})
+        self.assertEqual(self.api.multiCall.call_count, 2)
+        batch.flush()
+        self.assertEqual(self.api.multiCall.call_count, 3)
+
+    def test_read_concurrently(self):
+        """ Read records in parallel, a failure excludes only 1 record """
+        def call(method, arguments):
+            if arguments == [2]:
+                raise xmlrpclib.Fault(102, 'Customer not exists.')
+            return {'customer_id': str(arguments[0])}
+        self.api.call.side_effect = call
+        records = self.adapter.read_concurrently([1, 2, 3])
+        self.assertEqual(sorted(records), [1, 3])
+        self.assertEqual(records[3], {'customer_id': '3'})
+
+    def test_iter_search(self):
+        """ Search the records by windows of ids """
+        magento_ids = [1, 2, 3, 5, 9]
+
+        def call(method, arguments):
+            condition = arguments[0].get('entity_id')
+            if condition is None:
+                return magento_ids
+            # never an unbounded search
+            self.assertEqual(sorted(condition), ['from', 'to'])
+            self.assertLessEqual(condition['to'], 9)
+            return [i for i in magento_ids
+                    if condition['from'] <= i <= condition['to']]
+        self.api.call.side_effect = call
+        record_ids = self.adapter.iter_search(page_size=2, max_id=9)
+        self.assertFalse(self.api.call.called)
+        self.assertEqual(list(record_ids), magento_ids)
+        self.assertEqual(self.api.call.call_count, 5)
+        # without the highest id or with dates: a single search
+        self.api.call.reset_mock()
+        self.assertEqual(list(self.adapter.iter_search(page_size=2)),
+                         magento_ids)
+        self.assertEqual(
+            list(self.adapter.iter_search(
+                {'updated_at': {'from': '2014-01-01 00:00:00'}},
+                page_size=2, max_id=9)),
+            magento_ids)
+        self.assertEqual(self.api.call.call_count, 2)
+
+
+class test_api_stats(unittest2.TestCase):
+    """ Test the statistics of the API calls """
+
+    def test_record(self):
+        """ Calls are aggregated per method with a latency histogram """
+        stats = APIStats(autoflush=False)
+        stats.record('db', 1, 'customer.info', 0.05, size=10)
+        stats.record('db', 1, 'customer.info', 2, size=5)
+        stats.record('db', 1, 'customer.info', 7, fault='102')
+        stats.record('db', 1, 'customer.list', 0.2)
+        pending = stats.pop()
+        self.assertEqual(sorted(pending),
+                         [('db', 1, 'customer.info'),
+                          ('db', 1, 'customer.list')])
+        info = pending[('db', 1, 'customer.info')]
+        self.assertEqual(info.count, 3)
+        self.assertEqual(info.response_size, 15)
+        self.assertEqual(info.max_duration, 7)
+        self.assertEqual(info.latencies, [1, 0, 0, 1, 1])
+        self.assertEqual(info.faults, {'102': 1})
+        self.assertEqual(stats.pop(), {})
+
+    def test_record_call(self):
+        """ The calls of the adapters are recorded """
+        env = mock.MagicMock()
+        env.backend_config.id = 1
+        env.backend_config.api_max_concurrency = 0
+        env.backend_config.api_rate_limit = 0
+        env.session.cr.dbname = 'db'
+        adapter = PartnerAdapter(env)
+        with mock.patch('openerp.addons.magentoerpconnect.unit.'
+                        'backend_adapter.api_stats') as stats, \
+                mock.patch('magento.API') as API:
+            api = API.return_value
+            api.call.side_effect = xmlrpclib.Fault(102, 'Customer not exists.')
+            with self.assertRaises(IDMissingInBackend):
+                adapter.read(1)
+            stats.record.assert_called_once_with(
+                'db', 1, 'customer.info', mock.ANY, size=0, fault='102')
+        api_pool.clear()
+
+
+class test_rate_limiter(unittest2.TestCase):
+    """ Test the adaptive limits of the calls """
+
+    def test_token_bucket(self):
+        """ The calls are delayed when the rate is exceeded """
+        limiter = BackendLimiter()
+        limiter.configure(0, 2, 0)
+        limiter.tokens = 2
+        self.assertEqual(limiter.take_token(), 0)
+        self.assertEqual(limiter.take_token(), 0)
+        self.assertGreater(limiter.take_token(), 0)
+
+    def test_adapt(self):
+        """ The limits are lowered on overload and raised on success """
+        limiter = BackendLimiter()
+        limiter.configure(10, 0, 5)
+        limiter.observe(0.1, fault='http 503')
+        self.assertEqual(limiter.factor, 0.5)
+        self.assertEqual(limiter.slot_count, 5)
+        # cooldown: the limits are not lowered on each failed call
+        limiter.observe(0.1, fault='network')
+        self.assertEqual(limiter.factor, 0.5)
+        limiter.last_decrease = 0
+        limiter.observe(10)
+        self.assertEqual(limiter.factor, 0.25)
+        for __ in range(100):
+            limiter.last_decrease = 0
+            limiter.observe(0.1, fault='network')
+        self.assertEqual(limiter.factor, MIN_FACTOR)
+        self.assertEqual(limiter.slot_count, 1)
+        for __ in range(100):
+            limiter.observe(0.1)
+        self.assertEqual(limiter.factor, 1)
+        # any 5xx error
+        limiter.last_decrease = 0
+        limiter.observe(0.1, fault='http 500')
+        self.assertEqual(limiter.factor, 0.5)
+        limiter.last_decrease = 0
+        limiter.observe(0.1, fault='http 404')
+        self.assertEqual(limiter.factor, 0.5)
+
+
+class test_circuit_breaker(unittest2.TestCase):
+    """ Test the circuit breaker of the backends """
+
+    def setUp(self):
+        super(test_circuit_breaker, self).setUp()
+        self.breaker = CircuitBreaker()
+
+    def _fail(self, times):
+        for __ in range(times):
+            self.breaker.before_call('db', 1)
+            self.breaker.after_call('db', 1, fault='http 503')
+
+    def test_open(self):
+        """ The calls fail immediately after consecutive failures """
+        self._fail(FAILURE_THRESHOLD - 1)
+        # a fault of Magento means that it is available
+        self.breaker.after_call('db', 1, fault='102')
+        self._fail(FAILURE_THRESHOLD)
+        with self.assertRaises(BackendUnavailable):
+            self.breaker.before_call('db', 1)
+        # the other backends are not affected
+        self.breaker.before_call('db', 2)
+
+    def test_probe(self):
+        """ One call probes the backend after the delay """
+        self._fail(FAILURE_THRESHOLD)
+        circuit = self.breaker.circuit('db', 1)
+        circuit.opened_at -= RESET_TIMEOUT
+        self.breaker.before_call('db', 1)
+        # only one probe at a time
+        with self.assertRaises(BackendUnavailable):
+            self.breaker.before_call('db', 1)
+        # failed probe: opened again for a longer time
+        self.breaker.after_call('db', 1, fault='network')
+        self.assertEqual(circuit.reset_timeout, RESET_TIMEOUT * 2)
+        circuit.opened_at -= RESET_TIMEOUT * 2
+        self.breaker.before_call('db', 1)
+        self.breaker.after_call('db', 1)
+        self.breaker.before_call('db', 1)
+        self.assertEqual(circuit.reset_timeout, RESET_TIMEOUT)
+
+    def test_cancel_probe(self):
+        """ A probe which is not sent lets the next call probe """
+        self._fail(FAILURE_THRESHOLD)
+        circuit = self.breaker.circuit('db', 1)
+        circuit.opened_at -= RESET_TIMEOUT
+        self.assertTrue(self.breaker.before_call('db', 1))
+        self.breaker.cancel_probe('db', 1)
+        self.assertTrue(self.breaker.before_call('db', 1))
+
+    def test_transport_error(self):
+        """ The transport errors of the adapters are failures """
+        env = mock.MagicMock()
+        env.backend_config.id = 1
+        env.backend_config.api_max_concurrency = 0
+        env.backend_config.api_rate_limit = 0
+        env.session.cr.dbname = 'db'
+        adapter = PartnerAdapter(env)
+        with mock.patch('openerp.addons.magentoerpconnect.unit.'
+                        'backend_adapter.circuit_breaker') as breaker, \
+                mock.patch('magento.API') as API:
+            api = API.return_value
+            api.call.side_effect = httplib.BadStatusLine('')
+            with self.assertRaises(NetworkRetryableError):
+                adapter.read(1)
+            breaker.after_call.assert_called_once_with('db', 1,
+                                                       fault='network')
+            breaker.after_call.reset_mock()
+            api.call.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                adapter.read(1)
+            breaker.after_call.assert_called_once_with('db', 1,
+                                                       fault='error')
+        api_pool.clear()
+        self.breaker.after_call('db', 1, fault='error')
+        self.assertEqual(self.breaker.circuit('db', 1).failures, 1)
+
+
+class test_worker_cache(unittest2.TestCase):
+    """ Test the caches of the workers """
+
+    def test_version(self):
+        """ A value is computed again when its version changed """
+        cache = WorkerCache()
+        compute = mock.Mock(side_effect=[1, 2, 3])
+        self.assertEqual(cache.get('key', compute, version='a'), 1)
+        self.assertEqual(cache.get('key', compute, version='a'), 1)
+        self.assertEqual(cache.get('key', compute, version='b'), 2)
+        cache.clear()
+        self.assertEqual(cache.get('key', compute, version='b'), 3)
+
+    def test_timeout(self):
+        """ The values expire after the timeout """
+        cache = WorkerCache(timeout=-1)
+        compute = mock.Mock(side_effect=[1, 2])
+        self.assertEqual(cache.get('key', compute), 1)
+        self.assertEqual(cache.get('key', compute), 2)
+
+
+class test_json_default(unittest2.TestCase):
+    """ Test the serialization of the Magento data """
+
+    def test_xmlrpc_values(self):
+        """ The XML-RPC values are serialized by their value """
+        def dump():
+            record = {'date': xmlrpclib.DateTime('20140101T00:00:00'),
+                      'file': xmlrpclib.Binary('data')}
+            return json.dumps(record, sort_keys=True, default=json_default)
+        self.assertEqual(dump(), dump())
+        self.assertEqual(json.loads(dump()),
+                         {'date': '20140101T00:00:00', 'file': 'ZGF0YQ=='})
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import openerp.tests.common as common
+from openerp.addons.connector.queue.job import OpenERPJobStorage
+from openerp.addons.connector.session import ConnectorSession
+from ..consumer import delay_export, delay_export_record
+
+
+class test_export_coalescing(common.TransactionCase):
+    """ Test the merge of the export jobs of a binding """
+
+    def setUp(self):
+        super(test_export_coalescing, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.session = ConnectorSession(cr, uid)
+        backend_model = self.registry('magento.backend')
+        warehouse_id = self.ref('stock.warehouse0')
+        backend_id = backend_model.create(
+            cr,
+            uid,
+            {'name': 'Test Magento',
+             'version': '1.7',
+             'location': 'http://anyurl',
+             'username': 'username',
+             'warehouse_id': warehouse_id,
+             'password': '42'})
+        self.binding_id = self.registry('magento.product.product').create(
+            cr, uid,
+            {'openerp_id': self.ref('product.product_product_7'),
+             'backend_id': backend_id},
+            context={'connector_no_export': True})
+        self.QueueJob = self.registry('queue.job')
+
+    def _pending_jobs(self):
+        cr, uid = self.cr, self.uid
+        job_ids = self.QueueJob.search(
+            cr, uid,
+            [('model_name', '=', 'magento.product.product'),
+             ('state', '=', 'pending')])
+        storage = OpenERPJobStorage(self.session)
+        return [storage.load(job.uuid) for job
+                in self.QueueJob.browse(cr, uid, job_ids)]
+
+    def test_merge_fields(self):
+        """ The pending export absorbs the fields of the next writes """
+        delay_export(self.session, 'magento.product.product',
+                     self.binding_id, {'name': 'Pen'})
+        delay_export(self.session, 'magento.product.product',
+                     self.binding_id, {'list_price': 10})
+        jobs = self._pending_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].kwargs['fields'], ['list_price', 'name'])
+        job_ids = self.QueueJob.search(
+            self.cr, self.uid, [('uuid', '=', jobs[0].uuid)])
+        job = self.QueueJob.browse(self.cr, self.uid, job_ids[0])
+        self.assertEqual(job.magento_export_key,
+                         'magento.product.product,%d' % self.binding_id)
+
+    def test_merge_all_fields(self):
+        """ An export of all the fields absorbs the others """
+        delay_export(self.session, 'magento.product.product',
+                     self.binding_id, {'name': 'Pen'})
+        delay_export_record(self.session, 'magento.product.product',
+                            self.binding_id)
+        jobs = self._pending_jobs()
+        self.assertEqual(len(jobs), 1)
+        self.assertIsNone(jobs[0].kwargs['fields'])
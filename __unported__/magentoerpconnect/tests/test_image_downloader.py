@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import httplib
+import urllib2
+
+import mock
+import unittest2
+
+from openerp.addons.magentoerpconnect.unit.image_downloader import (
+    ImageDownloader,
+)
+
+
+def http_response(status, body='', headers=None, will_close=False):
+    response = mock.Mock()
+    response.status = status
+    response.reason = 'Reason'
+    response.will_close = will_close
+    response.read.return_value = body
+    response.getheaders.return_value = (headers or {}).items()
+    return response
+
+
+class test_image_downloader(unittest2.TestCase):
+    """ Test the download of the images """
+
+    def setUp(self):
+        super(test_image_downloader, self).setUp()
+        self.downloader = ImageDownloader()
+        patcher = mock.patch('httplib.HTTPConnection')
+        self.HTTPConnection = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _set_responses(self, *responses):
+        responses = list(responses)
+        self.connections = []
+
+        def connect(*args, **kwargs):
+            connection = mock.Mock()
+            connection.getresponse.side_effect = lambda: responses.pop(0)
+            self.connections.append(connection)
+            return connection
+        self.HTTPConnection.side_effect = connect
+
+    def test_reuse_connection(self):
+        """ The connections are kept alive between the downloads """
+        self._set_responses(http_response(200, 'img1'),
+                            http_response(200, 'img2'))
+        url = 'http://example.com/media/img%d.png'
+        self.assertEqual(self.downloader.download(url % 1).data, 'img1')
+        self.assertEqual(self.downloader.download(url % 2).data, 'img2')
+        self.assertEqual(self.HTTPConnection.call_count, 1)
+
+    def test_stale_connection(self):
+        """ A connection closed by the server is replaced """
+        self._set_responses(http_response(200, 'img1'),
+                            http_response(200, 'img2'))
+        url = 'http://example.com/media/img.png'
+        self.downloader.download(url)
+        connection = self.downloader._idle.values()[0][0]
+        connection.getresponse.side_effect = httplib.BadStatusLine('')
+        self.assertEqual(self.downloader.download(url).data, 'img2')
+        self.assertEqual(self.HTTPConnection.call_count, 2)
+
+    def test_not_modified(self):
+        """ Conditional download of an image which did not change """
+        self._set_responses(http_response(304))
+        response = self.downloader.download('http://example.com/img.png',
+                                            etag='"abc"')
+        self.assertTrue(response.not_modified)
+        connection = self.downloader._idle.values()[0][0]
+        connection.request.assert_called_once_with(
+            'GET', '/img.png', headers={'If-None-Match': '"abc"'})
+
+    def test_missing_and_errors(self):
+        """ A 404 returns None, the other errors are raised """
+        self._set_responses(http_response(404), http_response(403))
+        url = 'http://example.com/img.png'
+        self.assertIsNone(self.downloader.download(url))
+        with self.assertRaises(urllib2.HTTPError):
+            self.downloader.download(url)
+
+    def test_redirect(self):
+        """ The redirections are followed """
+        self._set_responses(
+            http_response(302, headers={'Location': '/other.png'}),
+            http_response(200, 'img', headers={'ETag': '"abc"'}))
+        response = self.downloader.download('http://example.com/img.png')
+        self.assertEqual(response.data, 'img')
+        self.assertEqual(response.etag, '"abc"')
+        self.assertEqual(response.url, 'http://example.com/other.png')
+
+    def test_redirect_other_host(self):
+        """ The credentials are not sent to another host """
+        self._set_responses(
+            http_response(302, headers={'Location': '/other.png'}),
+            http_response(302, headers={
+                'Location': 'http://cdn.example.org/img.png'}),
+            http_response(200, 'img'))
+        headers = {'Authorization': 'Basic Zm9vOmJhcg=='}
+        response = self.downloader.download('http://example.com/img.png',
+                                            headers=headers)
+        self.assertEqual(response.data, 'img')
+        sent = [call[1]['headers'] for connection in self.connections
+                for call in connection.request.call_args_list]
+        self.assertEqual([('Authorization' in h) for h in sent],
+                         [True, True, False])
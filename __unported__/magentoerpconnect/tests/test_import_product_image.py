@@ -19,6 +19,7 @@
 #
 ##############################################################################
 
+import hashlib
 import urllib2
 import mock
 from base64 import b64encode
@@ -27,13 +28,14 @@ from openerp.addons.magentoerpconnect.unit.import_synchronizer import (
     import_batch, import_record)
 from openerp.addons.connector.session import ConnectorSession
 import openerp.tests.common as common
-from .common import mock_api, MockResponseImage
+from .common import mock_api
 from .test_data import magento_base_responses
 from .test_data_product import simple_product_and_images
-from openerp.addons.magentoerpconnect.product import (
-    CatalogImageImporter,
-    ProductProductAdapter,
+from openerp.addons.magentoerpconnect.product import CatalogImageImporter
+from openerp.addons.magentoerpconnect.unit.image_downloader import (
+    image_downloader,
 )
+from openerp.addons.magentoerpconnect.connector import get_environment
 
 # simple square of 4 px filled with green in png, used for the product
 # images
@@ -88,50 +90,153 @@ class test_import_product_image(common.TransactionCase):
         self.assertEquals(importer._sort_images(images),
                           [file4, file3, file2, file1])
 
+    def _create_binding(self, product_xmlid='product.product_product_7'):
+        return self.product_model.create(
+            self.cr, self.uid,
+            {'openerp_id': self.ref(product_xmlid),
+             'backend_id': self.backend_id},
+            context={'connector_no_export': True})
+
+    def _get_importer(self):
+        env = get_environment(self.session, 'magento.product.product',
+                              self.backend_id)
+        return env.get_connector_unit(CatalogImageImporter)
+
     def test_import_images_404(self):
         """ An image responds a 404 error, skip and take the first valid """
-        env = mock.MagicMock()
-        env.get_connector_unit.return_value = ProductProductAdapter(env)
-        importer = CatalogImageImporter(env)
+        binding_id = self._create_binding()
+        importer = self._get_importer()
         url_tee1 = ('http://localhost:9100/media/catalog/product'
                     '/i/n/ink-eater-krylon-bombear-destroyed-tee-1.jpg')
         url_tee2 = ('http://localhost:9100/media/catalog/product/'
                     'i/n/ink-eater-krylon-bombear-destroyed-tee-2.jpg')
-        with mock.patch('urllib2.urlopen') as urlopen:
-            def image_url_response(url):
+        with mock.patch.object(image_downloader, '_request') as request:
+            def image_url_response(url, headers):
                 if url in (url_tee1, url_tee2):
-                    raise urllib2.HTTPError(url, 404, '404', None, None)
+                    return 404, 'Not Found', {}, ''
                 else:
-                    return MockResponseImage(PNG_IMG_4PX_GREEN)
+                    return 200, 'OK', {}, PNG_IMG_4PX_GREEN
 
-            urlopen.side_effect = image_url_response
+            request.side_effect = image_url_response
             with mock_api(simple_product_and_images):
-                importer.run(122, 999)
+                importer.run(122, binding_id)
 
-        env.session.write.assert_called_with(mock.ANY,
-                                             999,
-                                             {'image': B64_PNG_IMG_4PX_GREEN})
+        binding = self.product_model.browse(self.cr, self.uid, binding_id)
+        self.assertEqual(binding.image, B64_PNG_IMG_4PX_GREEN)
+        self.assertEqual(binding.magento_image_id.digest,
+                         hashlib.sha1(PNG_IMG_4PX_GREEN).hexdigest())
 
     def test_import_images_403(self):
         """ Import a product when an image respond a 403 error, should fail """
-        env = mock.MagicMock()
-        env.get_connector_unit.return_value = ProductProductAdapter(env)
-        importer = CatalogImageImporter(env)
+        binding_id = self._create_binding()
+        importer = self._get_importer()
         url_tee1 = ('http://localhost:9100/media/catalog/product'
                     '/i/n/ink-eater-krylon-bombear-destroyed-tee-1.jpg')
         url_tee2 = ('http://localhost:9100/media/catalog/product/'
                     'i/n/ink-eater-krylon-bombear-destroyed-tee-2.jpg')
-        with mock.patch('urllib2.urlopen') as urlopen:
-            def image_url_response(url):
-                url = url.get_full_url()
+        with mock.patch.object(image_downloader, '_request') as request:
+            def image_url_response(url, headers):
                 if url == url_tee2:
-                    raise urllib2.HTTPError(url, 404, '404', None, None)
+                    return 404, 'Not Found', {}, ''
                 elif url == url_tee1:
-                    raise urllib2.HTTPError(url, 403, '403', None, None)
+                    return 403, 'Forbidden', {}, ''
                 else:
-                    return MockResponseImage(PNG_IMG_4PX_GREEN)
+                    return 200, 'OK', {}, PNG_IMG_4PX_GREEN
 
-            urlopen.side_effect = image_url_response
+            request.side_effect = image_url_response
             with mock_api(simple_product_and_images):
                 with self.assertRaises(urllib2.HTTPError):
-                    importer.run(122, 999)
+                    importer.run(122, binding_id)
+
+    def test_import_images_not_modified(self):
+        """ The image did not change since the last import """
+        binding_id = self._create_binding()
+        importer = self._get_importer()
+        with mock.patch.object(image_downloader, '_request') as request:
+            request.return_value = (200, 'OK', {'etag': '"abc"'},
+                                    PNG_IMG_4PX_GREEN)
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding_id)
+            request.reset_mock()
+            request.return_value = 304, 'Not Modified', {}, ''
+            with mock.patch.object(self.session, 'write') as write:
+                with mock_api(simple_product_and_images):
+                    importer.run(122, binding_id)
+                self.assertFalse(write.called)
+            request.assert_called_once_with(mock.ANY,
+                                            {'If-None-Match': '"abc"'})
+
+    def test_import_images_shared(self):
+        """ The same image is stored once for many products """
+        binding1_id = self._create_binding()
+        binding2_id = self._create_binding('product.product_product_8')
+        importer = self._get_importer()
+        with mock.patch.object(image_downloader, '_request') as request:
+            request.return_value = 200, 'OK', {}, PNG_IMG_4PX_GREEN
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding1_id)
+                importer.run(122, binding2_id)
+        binding1 = self.product_model.browse(self.cr, self.uid, binding1_id)
+        binding2 = self.product_model.browse(self.cr, self.uid, binding2_id)
+        self.assertTrue(binding1.magento_image_id)
+        self.assertEqual(binding1.magento_image_id, binding2.magento_image_id)
+        self.assertEqual(binding2.image, B64_PNG_IMG_4PX_GREEN)
+
+    def test_import_images_shared_not_modified(self):
+        """ An image not modified is copied from the products using it """
+        binding1_id = self._create_binding()
+        binding2_id = self._create_binding('product.product_product_8')
+        importer = self._get_importer()
+        with mock.patch.object(image_downloader, '_request') as request:
+            request.return_value = (200, 'OK', {'etag': '"abc"'},
+                                    PNG_IMG_4PX_GREEN)
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding1_id)
+            request.return_value = 304, 'Not Modified', {}, ''
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding2_id)
+        binding1 = self.product_model.browse(self.cr, self.uid, binding1_id)
+        binding2 = self.product_model.browse(self.cr, self.uid, binding2_id)
+        self.assertEqual(binding1.magento_image_id, binding2.magento_image_id)
+        self.assertEqual(binding2.image, B64_PNG_IMG_4PX_GREEN)
+
+    def test_import_images_not_modified_cleared(self):
+        """ An image not modified is downloaded again when no product
+        has its content anymore """
+        binding1_id = self._create_binding()
+        binding2_id = self._create_binding('product.product_product_8')
+        importer = self._get_importer()
+        with mock.patch.object(image_downloader, '_request') as request:
+            request.return_value = (200, 'OK', {'etag': '"abc"'},
+                                    PNG_IMG_4PX_GREEN)
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding1_id)
+            self.product_model.write(self.cr, self.uid, binding1_id,
+                                     {'image': False},
+                                     context={'connector_no_export': True})
+            request.reset_mock()
+            request.side_effect = [
+                (304, 'Not Modified', {}, ''),
+                (200, 'OK', {'etag': '"abc"'}, PNG_IMG_4PX_GREEN)]
+            with mock_api(simple_product_and_images):
+                importer.run(122, binding2_id)
+        self.assertEqual(request.call_count, 2)
+        binding2 = self.product_model.browse(self.cr, self.uid, binding2_id)
+        self.assertEqual(binding2.image, B64_PNG_IMG_4PX_GREEN)
+
+    def test_garbage_collect(self):
+        """ The images no longer used by a product are deleted """
+        image_model = self.registry('magento.product.image')
+        image_id = image_model.create(self.cr, self.uid,
+                                      {'digest': 'a' * 40})
+        binding_id = self._create_binding()
+        self.product_model.write(self.cr, self.uid, binding_id,
+                                 {'magento_image_id': image_id},
+                                 context={'connector_no_export': True})
+        image_model.garbage_collect(self.cr, self.uid)
+        self.assertTrue(image_model.exists(self.cr, self.uid, image_id))
+        self.product_model.write(self.cr, self.uid, binding_id,
+                                 {'magento_image_id': False},
+                                 context={'connector_no_export': True})
+        image_model.garbage_collect(self.cr, self.uid)
+        self.assertFalse(image_model.exists(self.cr, self.uid, image_id))
@@ -19,13 +19,36 @@
 #
 ##############################################################################
 
+from datetime import datetime
 from functools import partial
+import xmlrpclib
 
-from openerp.addons.connector.exception import InvalidDataError
+import mock
+
+from openerp.addons.connector.exception import (InvalidDataError,
+                                                NetworkRetryableError)
 from openerp.addons.magentoerpconnect.unit.import_synchronizer import (
+    apply_payload,
     import_batch,
-    import_record)
+    import_record,
+    import_record_chunk)
 from openerp.addons.connector.session import ConnectorSession
+from openerp.addons.magentoerpconnect.connector import (
+    get_backend_config,
+    get_environment,
+    reset_backend_config,
+)
+from openerp.addons.magentoerpconnect.partner import (
+    address_lookup,
+    reset_address_lookup)
+from openerp.addons.magentoerpconnect.sale import SaleOrderBatchImport
+from openerp.addons.magentoerpconnect.product_category import (
+    ProductCategoryBatchImport,
+    ProductCategoryImport,
+    import_category_levels)
+from openerp.addons.magentoerpconnect.unit.api_stats import MethodStats
+from openerp.addons.magentoerpconnect.unit.backend_adapter import (
+    call_to_key)
 import openerp.tests.common as common
 from .common import (mock_api,
                      mock_urlopen_image)
@@ -108,6 +131,92 @@ class TestBaseMagento(SetUpMagentoBase):
 
         # TODO; install & configure languages on storeviews
 
+    def test_01_api_stats(self):
+        """ The statistics of the workers are inserted, then summed """
+        stats_model = self.registry('magento.api.stats')
+        stats = MethodStats()
+        stats.add(0.2, 10)
+        stats.add(6, 0, fault='102')
+        for __ in range(2):
+            stats_model.add_stats(
+                self.cr, self.uid,
+                [(self.backend_id, 'customer.info', stats)])
+        domain = [('backend_id', '=', self.backend_id)]
+        self.assertEqual(
+            len(stats_model.search(self.cr, self.uid, domain)), 2)
+        group = stats_model.read_group(
+            self.cr, self.uid, domain,
+            ['method', 'call_count', 'fault_count', 'max_duration'],
+            ['method'])[0]
+        self.assertEqual(group['call_count'], 4)
+        self.assertEqual(group['fault_count'], 2)
+        self.assertEqual(group['max_duration'], 6)
+        # the old statistics are deleted
+        stats_ids = stats_model.search(self.cr, self.uid, domain)
+        stats_model.write(self.cr, self.uid, stats_ids[:1],
+                          {'date': '2014-01-01 00:00:00'})
+        stats_model.purge(self.cr, self.uid)
+        self.assertEqual(
+            sorted(stats_model.search(self.cr, self.uid, domain)),
+            sorted(stats_ids[1:]))
+
+    def test_01_backend_config(self):
+        """ Snapshot of the configuration of the backend """
+        config = get_backend_config(self.session, self.backend_id)
+        self.assertEqual(config.location, 'http://anyurl')
+        self.assertEqual(config.lang_code, 'en_US')
+        self.assertEqual(config.stock_field, 'virtual_available')
+        self.assertIs(get_backend_config(self.session, self.backend_id),
+                      config)
+        env = get_environment(self.session, 'magento.website',
+                              self.backend_id)
+        self.assertIs(env.backend_config, config)
+        # the dates of the imports are not in the configuration
+        self.backend_model.write(self.cr, self.uid, self.backend_id,
+                                 {'import_products_from_date': False})
+        reset_backend_config(self.session)
+        self.assertIs(get_backend_config(self.session, self.backend_id),
+                      config)
+        __, lang_id = self.get_ref('base', 'lang_en')
+        self.backend_model.write(self.cr, self.uid, self.backend_id,
+                                 {'location': 'http://otherurl',
+                                  'default_lang_id': lang_id})
+        # the version is checked once per session
+        self.assertIs(get_backend_config(self.session, self.backend_id),
+                      config)
+        reset_backend_config(self.session)
+        new_config = get_backend_config(self.session, self.backend_id)
+        self.assertEqual(new_config.location, 'http://otherurl')
+        self.assertEqual(new_config.default_lang_code, 'en_US')
+        self.assertNotEqual(new_config.config_version,
+                            config.config_version)
+        with mock_api(magento_base_responses):
+            import_batch(self.session, 'magento.website', self.backend_id)
+        config = get_backend_config(self.session, self.backend_id)
+        self.assertEqual(len(config.websites), 2)
+        # the stock location of the warehouse
+        self.registry('stock.location').write(
+            self.cr, self.uid, config.stock_location_id,
+            {'name': 'Magento Stock'})
+        self.assertIsNot(get_backend_config(
+            ConnectorSession(self.cr, self.uid), self.backend_id), config)
+        reset_backend_config(self.session)
+        self.assertIsNot(get_backend_config(self.session, self.backend_id),
+                         config)
+
+    def test_01_address_lookup(self):
+        """ The lookup tables of the addresses follow the database """
+        lookup = address_lookup(self.session)
+        self.assertIs(address_lookup(self.session), lookup)
+        title_id = self.registry('res.partner.title').create(
+            self.cr, self.uid,
+            {'domain': 'contact', 'name': 'Doctor', 'shortcut': 'Dr.'})
+        # the version is checked once per session
+        self.assertIs(address_lookup(self.session), lookup)
+        reset_address_lookup(self.session)
+        lookup = address_lookup(self.session)
+        self.assertIn(('dr.', title_id), lookup.titles)
+
 
 class SetUpMagentoSynchronized(SetUpMagentoBase):
 
@@ -135,6 +244,30 @@ class TestImportMagento(SetUpMagentoSynchronized):
             self.cr, self.uid, [('backend_id', '=', backend_id)])
         self.assertEqual(len(category_ids), 1)
 
+    def test_10_import_product_category_unchanged(self):
+        """ Skip the import of the same data on a product category """
+        backend_id = self.backend_id
+        category_model = self.registry('magento.product.category')
+        with mock_api(magento_base_responses):
+            import_record(self.session, 'magento.product.category',
+                          backend_id, 1)
+            category_ids = category_model.search(
+                self.cr, self.uid, [('backend_id', '=', backend_id)])
+            category_model.write(self.cr, self.uid, category_ids,
+                                 {'name': 'Modified'},
+                                 context={'connector_no_export': True})
+            import_record(self.session, 'magento.product.category',
+                          backend_id, 1, force=True)
+            category = category_model.browse(self.cr, self.uid,
+                                             category_ids[0])
+            self.assertEqual(category.name, 'Modified')
+            # an export empties the hash
+            category.write({'magento_hash': False})
+            import_record(self.session, 'magento.product.category',
+                          backend_id, 1, force=True)
+        category.refresh()
+        self.assertNotEqual(category.name, 'Modified')
+
     def test_11_import_product_category_with_gap(self):
         """ Import of a product category when parent categories are missing """
         backend_id = self.backend_id
@@ -147,6 +280,138 @@ class TestImportMagento(SetUpMagentoSynchronized):
             self.cr, self.uid, [('backend_id', '=', backend_id)])
         self.assertEqual(len(category_ids), 4)
 
+    def test_11_import_product_category_tree_diff(self):
+        """ Batch import of the new, moved and modified categories only """
+        backend_id = self.backend_id
+        with mock_api(magento_base_responses):
+            import_record(self.session, 'magento.product.category',
+                          backend_id, 8)
+        category_model = self.registry('magento.product.category')
+        binding_ids = dict(
+            (category.magento_id, category.id) for category
+            in category_model.browse(
+                self.cr, self.uid,
+                category_model.search(self.cr, self.uid,
+                                      [('backend_id', '=', backend_id)])))
+        # category 8 is now a child of category 1 in OpenERP, so it has
+        # been moved in Magento
+        category_model.write(self.cr, self.uid, binding_ids['8'],
+                             {'magento_parent_id': binding_ids['1']})
+
+        responses = dict(magento_base_responses)
+        responses['oerp_catalog_category.search'] = ['22']
+
+        def key_func(method, arguments):
+            if method == 'oerp_catalog_category.search':
+                return method
+            return call_to_key(method, arguments)
+
+        patched = mock.patch.object(ProductCategoryBatchImport,
+                                    '_import_levels')
+        with mock_api(responses, key_func=key_func), \
+                patched as import_levels_mock:
+            import_batch(self.session, 'magento.product.category',
+                         backend_id,
+                         filters={'from_date': datetime(2014, 1, 1)})
+        levels = import_levels_mock.call_args[0][0]
+        imported_ids = [category_id for level in levels
+                        for category_id in level]
+        self.assertIn('8', imported_ids)
+        self.assertIn('22', imported_ids)
+        self.assertNotIn('1', imported_ids)
+        self.assertNotIn('3', imported_ids)
+        self.assertNotIn('13', imported_ids)
+
+    def test_11_import_product_category_levels(self):
+        """ Import the categories level by level, parents first """
+        backend_id = self.backend_id
+        patched = mock.patch.object(import_category_levels, 'delay')
+        with mock_api(magento_base_responses) as calls_done, \
+                patched as delay_mock:
+            import_category_levels(self.session, 'magento.product.category',
+                                   backend_id, [['1'], ['3', '13']])
+            # the next level is imported only once the first one is
+            delay_mock.assert_called_once_with(
+                self.session, 'magento.product.category', backend_id,
+                [['3', '13']], force=False)
+            import_category_levels(self.session, 'magento.product.category',
+                                   backend_id, [['3', '13']])
+        category_model = self.registry('magento.product.category')
+        category_ids = category_model.search(
+            self.cr, self.uid, [('backend_id', '=', backend_id)])
+        self.assertEqual(len(category_ids), 3)
+        # the parents were there, each category has been read once
+        info_calls = [arguments for method, arguments in calls_done
+                      if method == 'catalog_category.info' and
+                      arguments[1] is None]
+        self.assertEqual(len(info_calls), 3)
+
+    def test_11_import_product_category_level_chunks(self):
+        """ The levels of categories are imported by chunks """
+        self.backend_model.write(self.cr, self.uid, self.backend_id,
+                                 {'import_categories_chunk_size': 2})
+        env = get_environment(self.session, 'magento.product.category',
+                              self.backend_id)
+        importer = env.get_connector_unit(ProductCategoryBatchImport)
+        with mock.patch.object(import_category_levels, 'delay') as delay:
+            importer._import_levels([['1'], ['3', '13', '14']])
+        delay.assert_called_once_with(
+            self.session, 'magento.product.category', self.backend_id,
+            [['1'], ['3', '13'], ['14']])
+
+    def test_11_import_product_category_chunk_retry(self):
+        """ A chunk is retried when Magento is unavailable """
+        error = NetworkRetryableError('connection refused')
+        patched = mock.patch.object(ProductCategoryImport, 'run',
+                                    side_effect=error)
+        with mock_api(magento_base_responses), patched, \
+                mock.patch.object(import_record, 'delay') as delay_mock:
+            with self.assertRaises(NetworkRetryableError):
+                import_record_chunk(self.session,
+                                    'magento.product.category',
+                                    self.backend_id, ['1', '3'])
+        self.assertFalse(delay_mock.called)
+
+    def test_11_import_product_category_staged(self):
+        """ Import of a product category from its stored data """
+        backend_id = self.backend_id
+        payload_obj = self.registry('magento.import.payload')
+        record = magento_base_responses[('catalog_category.info',
+                                         (1, None, None))]
+        payload_id = payload_obj.store(self.cr, self.uid, backend_id,
+                                       'magento.product.category', 1,
+                                       record)
+        # stored once
+        self.assertEqual(
+            payload_obj.store(self.cr, self.uid, backend_id,
+                              'magento.product.category', 1, record),
+            payload_id)
+        self.assertEqual(payload_obj.load(self.cr, self.uid, payload_id),
+                         record)
+        # without update date, other data are stored again
+        other = {'category_id': '1', 'name': 'Other',
+                 'created_at': xmlrpclib.DateTime('20140101T00:00:00')}
+        other_id = payload_obj.store(self.cr, self.uid, backend_id,
+                                     'magento.product.category', 1, other)
+        self.assertNotEqual(other_id, payload_id)
+        other['name'] = 'Another'
+        self.assertNotEqual(
+            payload_obj.store(self.cr, self.uid, backend_id,
+                              'magento.product.category', 1, other),
+            other_id)
+        with mock_api(magento_base_responses) as calls_done:
+            apply_payload(self.session, 'magento.product.category',
+                          backend_id, payload_id)
+        self.assertNotIn(('catalog_category.info', [1, None, None]),
+                         calls_done)
+        category_model = self.registry('magento.product.category')
+        category_ids = category_model.search(
+            self.cr, self.uid, [('backend_id', '=', backend_id),
+                                ('magento_id', '=', '1')])
+        self.assertEqual(len(category_ids), 1)
+        payload = payload_obj.browse(self.cr, self.uid, payload_id)
+        self.assertEqual(payload.state, 'done')
+
     def test_12_import_product(self):
         """ Import of a simple product """
         backend_id = self.backend_id
@@ -252,6 +517,88 @@ class TestImportMagento(SetUpMagentoSynchronized):
                                         ('magento_id', '=', '900000692')])
         self.assertEqual(len(order_ids), 1)
 
+    def test_31_import_sale_order_reuse_addresses(self):
+        """ Import sale orders: the addresses of the customer are reused """
+        backend_id = self.backend_id
+        with mock_api(magento_base_responses):
+            with mock_urlopen_image():
+                import_record(self.session,
+                              'magento.sale.order',
+                              backend_id, 900000691)
+                import_record(self.session,
+                              'magento.sale.order',
+                              backend_id, 900000693)
+        order_model = self.registry('magento.sale.order')
+        order_ids = order_model.search(
+            self.cr, self.uid,
+            [('backend_id', '=', backend_id),
+             ('magento_id', 'in', ['900000691', '900000693'])])
+        orders = order_model.browse(self.cr, self.uid, order_ids)
+        self.assertEqual(len(orders), 2)
+        self.assertEqual(orders[0].partner_invoice_id,
+                         orders[1].partner_invoice_id)
+        # the same address is used for the shipping
+        self.assertEqual(orders[0].partner_invoice_id,
+                         orders[0].partner_shipping_id)
+
+    def test_31_import_sale_order_prefetch(self):
+        """ Batch import of sale orders: the jobs receive the orders """
+        env = get_environment(self.session, 'magento.sale.order',
+                              self.backend_id)
+        importer = env.get_connector_unit(SaleOrderBatchImport)
+        patched = mock.patch.object(import_record, 'delay')
+        with mock_api(magento_base_responses) as calls_done, \
+                patched as delay_mock:
+            importer._import_records(iter([900000691, 900000692]))
+        # one multiCall for both orders
+        self.assertEqual(calls_done, [
+            ('sales_order.info', [900000691, None]),
+            ('sales_order.info', [900000692, None]),
+        ])
+        self.assertEqual(delay_mock.call_count, 2)
+        # the jobs receive the id of the stored data, not the data
+        kwargs = delay_mock.call_args_list[0][1]
+        self.assertNotIn('record', kwargs)
+        payload_id = kwargs['payload_id']
+        payload_obj = self.registry('magento.import.payload')
+        record = payload_obj.load(self.cr, self.uid, payload_id)
+        self.assertEqual(record['increment_id'], '900000691')
+
+        def status_responses(record, **changes):
+            status = {'increment_id': record['increment_id'],
+                      'updated_at': record['updated_at'],
+                      'status': record['status']}
+            status.update(changes)
+            key = call_to_key('sales_order.list',
+                              [{'increment_id':
+                                {'eq': record['increment_id']}}])
+            responses = dict(magento_base_responses)
+            responses[key] = [status]
+            return responses
+
+        with mock_api(status_responses(record)) as calls_done:
+            with mock_urlopen_image():
+                import_record(self.session, 'magento.sale.order',
+                              self.backend_id, 900000691,
+                              payload_id=payload_id)
+        # the order has not been modified, the stored data are used
+        self.assertNotIn(('sales_order.info', [900000691, None]),
+                         calls_done)
+        # used once: a retry of the job reads the order again
+        self.assertIsNone(payload_obj.load_pending(
+            self.cr, self.uid, payload_id))
+        # the order has been modified since: it is read again, even if
+        # its job runs long after the batch import
+        payload_id = delay_mock.call_args_list[1][1]['payload_id']
+        record = payload_obj.load(self.cr, self.uid, payload_id)
+        responses = status_responses(record, status='processing')
+        with mock_api(responses) as calls_done:
+            with mock_urlopen_image():
+                import_record(self.session, 'magento.sale.order',
+                              self.backend_id, 900000692,
+                              payload_id=payload_id)
+        self.assertIn(('sales_order.info', [900000692, None]), calls_done)
+
     def test_32_import_sale_order_with_prefix(self):
         """ Import sale order with prefix """
         backend_id = self.backend_id
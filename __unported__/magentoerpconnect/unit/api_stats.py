@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Statistics on the calls to the Magento API.
+
+Each call done by the adapters is recorded with its duration, the size of
+its response and its fault code.  The statistics are kept in memory and
+periodically written in ``magento.api.stats`` and summarized in the logs
+by a thread of the process, so the calls never wait for the database.
+The statistics are written with a new cursor, they are kept even when
+the job fails.  The thread is started by the first call of the process,
+it is not started when the tests are enabled.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+import openerp
+from openerp import SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+# Interval (in seconds) between 2 writes of the statistics
+FLUSH_INTERVAL = 60
+# Upper bounds (in seconds) of the buckets of the latency histogram,
+# the last bucket counts the calls above the last bound
+LATENCY_BUCKETS = (0.1, 0.5, 1.0, 5.0)
+# Number of methods shown in the log summary
+SUMMARY_SIZE = 10
+
+
+def payload_size(value):
+    """ Approximative size of a response of Magento, without the XML """
+    if isinstance(value, basestring):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(len(key) + payload_size(item)
+                   for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return sum(payload_size(item) for item in value)
+    elif value is None:
+        return 0
+    return len(str(value))
+
+
+class MethodStats(object):
+    """ Statistics of the calls of a method """
+
+    def __init__(self):
+        self.count = 0
+        self.total_duration = 0.
+        self.max_duration = 0.
+        self.response_size = 0
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.faults = {}
+
+    def add(self, duration, size, fault=None):
+        self.count += 1
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        self.response_size += size
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.latencies[index] += 1
+                break
+        else:
+            self.latencies[-1] += 1
+        if fault is not None:
+            self.faults[fault] = self.faults.get(fault, 0) + 1
+
+    @property
+    def fault_count(self):
+        return sum(self.faults.itervalues())
+
+
+class APIStats(object):
+    """ Collect the statistics of the calls in the current process """
+
+    def __init__(self, autoflush=True):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.autoflush = autoflush
+        # process of the flushing thread, a forked worker starts its own
+        self._flusher_pid = None
+
+    def record(self, dbname, backend_id, method, duration,
+               size=0, fault=None):
+        """ Record a call, never fails """
+        try:
+            with self._lock:
+                key = (dbname, backend_id, method)
+                stats = self._pending.get(key)
+                if stats is None:
+                    stats = self._pending[key] = MethodStats()
+                stats.add(duration, size, fault=fault)
+            if self.autoflush:
+                self._start_flusher()
+        except Exception:
+            _logger.exception('Failed to record the statistics of the '
+                              'Magento API call %s', method)
+
+    def _start_flusher(self):
+        """ Start the thread writing the statistics of the process
+
+        Started by the first recorded call, not when the tests run.
+        """
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+        if openerp.tools.config.get('test_enable'):
+            return
+        with self._lock:
+            if self._flusher_pid == pid:
+                return
+            self._flusher_pid = pid
+        thread = threading.Thread(target=self._flush_loop,
+                                  name='magento.api.stats')
+        thread.daemon = True
+        thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                _logger.exception('Failed to flush the statistics of the '
+                                  'Magento API calls')
+
+    def pop(self):
+        """ Return the statistics collected since the last flush and
+        start a new collect """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def flush(self):
+        """ Log a summary and write the collected statistics """
+        pending = self.pop()
+        if not pending:
+            return
+        self._log_summary(pending)
+        by_db = {}
+        for (dbname, backend_id, method), stats in pending.iteritems():
+            by_db.setdefault(dbname, []).append((backend_id, method, stats))
+        for dbname, db_stats in by_db.iteritems():
+            try:
+                self._write(dbname, db_stats)
+            except Exception:
+                _logger.exception('Failed to write the statistics of '
+                                  'the Magento API calls')
+
+    def _write(self, dbname, db_stats):
+        registry = openerp.modules.registry.RegistryManager.get(dbname)
+        cr = registry.db.cursor()
+        try:
+            stats_obj = registry['magento.api.stats']
+            stats_obj.add_stats(cr, SUPERUSER_ID, db_stats)
+            cr.commit()
+        finally:
+            cr.close()
+
+    def _log_summary(self, pending):
+        by_method = {}
+        for (__, __, method), stats in pending.iteritems():
+            by_method.setdefault(method, []).append(stats)
+        lines = []
+        for method, method_stats in by_method.iteritems():
+            count = sum(stats.count for stats in method_stats)
+            duration = sum(stats.total_duration for stats in method_stats)
+            lines.append(
+                (duration,
+                 '%s: %d calls, %.2fs total, %.3fs avg, %.3fs max, '
+                 '%d faults' %
+                 (method, count, duration, duration / count,
+                  max(stats.max_duration for stats in method_stats),
+                  sum(stats.fault_count for stats in method_stats))))
+        lines.sort(reverse=True)
+        _logger.info('Magento API calls:\n%s',
+                     '\n'.join(line for __, line in lines[:SUMMARY_SIZE]))
+
+
+api_stats = APIStats()
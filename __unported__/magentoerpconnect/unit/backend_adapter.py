@@ -19,17 +19,45 @@
 #
 ##############################################################################
 
+import httplib
 import socket
 import logging
+import threading
+import time
 import xmlrpclib
+from multiprocessing.pool import ThreadPool
 
 import magento as magentolib
 from openerp.addons.connector.unit.backend_adapter import CRUDAdapter
 from openerp.addons.connector.exception import (NetworkRetryableError,
                                                 RetryableJobError)
+from ..connector import backend_config
+from .api_stats import api_stats, payload_size
+from .circuit_breaker import circuit_breaker, ERROR_FAULT
+from .rate_limiter import rate_limiter
 
 _logger = logging.getLogger(__name__)
 
+# Magento's fault raised when the API session is no longer valid
+SESSION_EXPIRED_FAULT = 5
+# Sessions unused since this delay (in seconds) are closed.  Must be
+# lower than the session lifetime configured in Magento (1 hour by
+# default)
+SESSION_IDLE_TIMEOUT = 600
+# Number of calls sent in one multiCall by a MagentoBatch
+DEFAULT_BATCH_SIZE = 50
+# Number of parallel requests done by GenericAdapter.read_concurrently
+DEFAULT_READ_WORKERS = 4
+# Size of the windows of ids searched by GenericAdapter.iter_search
+DEFAULT_PAGE_SIZE = 1000
+# Filters on dates: the searches using them are not paginated
+DATE_FILTER_FIELDS = frozenset(['created_at', 'updated_at'])
+# Errors of the transport of the calls: Magento may be unreachable or
+# overloaded, the calls can be done again later
+TRANSPORT_ERRORS = (socket.error,
+                    httplib.HTTPException,
+                    xmlrpclib.ProtocolError)
+
 
 recorder = {}
 
@@ -98,6 +126,157 @@ class MagentoLocation(object):
         return location
 
 
+class MagentoAPIPool(object):
+    """ Pool of authenticated Magento API sessions.
+
+    Opening a ``magento.API`` context manager for each call costs a
+    ``login`` and an ``endSession`` request, in addition to the
+    requested method. The pool keeps the logged-in API objects between
+    the calls, so their session id and their HTTP connection (kept
+    alive by ``xmlrpclib``) are reused.
+
+    An API object is used by one thread at a time: it is taken from
+    the pool with :meth:`acquire` and given back with :meth:`release`.
+    The sessions which were not used since ``idle_timeout`` seconds are
+    closed.
+    """
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> list of (api, time of last use)
+        self._idle = {}
+
+    @staticmethod
+    def _key(magento):
+        return (magento.location,
+                magento.username,
+                magento.password,
+                magento.use_custom_api_path)
+
+    @staticmethod
+    def _connect(magento):
+        """ Open a new API session: ``connect()`` only creates the
+        proxy, the session id is given by the ``login`` """
+        api = magentolib.API(magento.location,
+                             magento.username,
+                             magento.password,
+                             full_url=magento.use_custom_api_path)
+        api.connect()
+        api.session = api.client.login(magento.username, magento.password)
+        return api
+
+    @staticmethod
+    def _logout(api):
+        try:
+            api.__exit__(None, None, None)
+        except Exception:
+            # the session is dropped anyway
+            _logger.debug('error when closing a Magento session',
+                          exc_info=True)
+
+    def _pop_expired(self):
+        """ Remove the idle sessions unused for too long and return them
+
+        Must be called with the lock held.
+        """
+        limit = time.time() - self.idle_timeout
+        expired = []
+        for key, sessions in self._idle.items():
+            alive = []
+            for api, last_use in sessions:
+                if last_use < limit:
+                    expired.append(api)
+                else:
+                    alive.append((api, last_use))
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+        return expired
+
+    def acquire(self, magento):
+        """ Return a logged-in API object for a location
+
+        An idle session is reused when possible, otherwise a new one is
+        opened.
+
+        :param magento: Magento location
+        :type magento: :class:`MagentoLocation`
+        """
+        api = None
+        with self._lock:
+            expired = self._pop_expired()
+            sessions = self._idle.get(self._key(magento))
+            if sessions:
+                api, __ = sessions.pop()
+        for old_api in expired:
+            self._logout(old_api)
+        if api is None:
+            api = self._connect(magento)
+        return api
+
+    def release(self, magento, api):
+        """ Give back an API object acquired with :meth:`acquire` """
+        with self._lock:
+            sessions = self._idle.setdefault(self._key(magento), [])
+            sessions.append((api, time.time()))
+
+    def discard(self, magento):
+        """ Forget the idle sessions of a location without closing them
+
+        Used when Magento told us that a session expired: the other
+        sessions opened at the same time have probably expired too.
+        """
+        with self._lock:
+            self._idle.pop(self._key(magento), None)
+
+    def clear(self):
+        """ Close all the idle sessions """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for sessions in idle.itervalues():
+            for api, __ in sessions:
+                self._logout(api)
+
+    def execute(self, magento, func):
+        """ Execute ``func(api)`` with a pooled API object
+
+        When the session has expired on Magento, a new one is opened
+        and ``func`` is called again.  When the connection failed, the
+        API object is not put back in the pool.
+
+        :param magento: Magento location
+        :type magento: :class:`MagentoLocation`
+        :param func: callable receiving the API object
+        :return: the result of ``func``
+        """
+        api = self.acquire(magento)
+        try:
+            try:
+                result = func(api)
+            except xmlrpclib.Fault as err:
+                if err.faultCode != SESSION_EXPIRED_FAULT:
+                    raise
+                _logger.debug('Magento session expired, login again')
+                self.discard(magento)
+                api = self._connect(magento)
+                result = func(api)
+        except TRANSPORT_ERRORS:
+            # the connection is in an unknown state, do not reuse it
+            raise
+        except Exception:
+            self.release(magento, api)
+            raise
+        self.release(magento, api)
+        return result
+
+
+api_pool = MagentoAPIPool()
+""" Pool of the Magento API sessions of the current process """
+
+
 class MagentoCRUDAdapter(CRUDAdapter):
     """ External Records Adapter for Magento """
 
@@ -108,17 +287,21 @@ class MagentoCRUDAdapter(CRUDAdapter):
         :type environment: :py:class:`connector.connector.Environment`
         """
         super(MagentoCRUDAdapter, self).__init__(environment)
-        backend = self.backend_record
+        config = backend_config(environment)
+        self.backend_config = config
         magento = MagentoLocation(
-            backend.location,
-            backend.username,
-            backend.password,
-            use_custom_api_path=backend.use_custom_api_path)
-        if backend.use_auth_basic:
+            config.location,
+            config.username,
+            config.password,
+            use_custom_api_path=config.use_custom_api_path)
+        if config.use_auth_basic:
             magento.use_auth_basic = True
-            magento.auth_basic_username = backend.auth_basic_username
-            magento.auth_basic_password = backend.auth_basic_password
+            magento.auth_basic_username = config.auth_basic_username
+            magento.auth_basic_password = config.auth_basic_password
         self.magento = magento
+        # used by MagentoBatch
+        self._collected_calls = None
+        self._batch_responses = {}
 
     def search(self, filters=None):
         """ Search records according to some criterias
@@ -146,24 +329,41 @@ class MagentoCRUDAdapter(CRUDAdapter):
         """ Delete a record on the external system """
         raise NotImplementedError
 
-    def _call(self, method, arguments):
+    def _execute(self, func, method=None):
+        """ Execute ``func(api)`` with a pooled API session and convert
+        the network errors to retryable errors
+
+        The call is not done when the circuit of the backend is open
+        (see :mod:`~openerp.addons.magentoerpconnect.unit.circuit_breaker`),
+        it is subject to the limits of the backend (see
+        :mod:`~openerp.addons.magentoerpconnect.unit.rate_limiter`) and
+        is recorded in the statistics of the API calls under the name
+        ``method``.
+        """
+        dbname = self.session.cr.dbname
+        backend = self.backend_config
+        probe = circuit_breaker.before_call(dbname, backend.id)
         try:
-            custom_url = self.magento.use_custom_api_path
-            with magentolib.API(self.magento.location,
-                                self.magento.username,
-                                self.magento.password,
-                                full_url=custom_url) as api:
-                result = api.call(method, arguments)
-                # Uncomment to record requests/responses in ``recorder``
-                # record(method, arguments, result)
-                _logger.debug("api.call(%s, %s) returned %s",
-                              method, arguments, result)
-                return result
-        except (socket.gaierror, socket.error, socket.timeout) as err:
+            slot = rate_limiter.acquire(dbname, backend)
+        except Exception:
+            if probe:
+                circuit_breaker.cancel_probe(dbname, backend.id)
+            raise
+        start = time.time()
+        result = fault = None
+        try:
+            result = api_pool.execute(self.magento, func)
+            return result
+        except xmlrpclib.Fault as err:
+            fault = str(err.faultCode)
+            raise
+        except (socket.error, httplib.HTTPException) as err:
+            fault = 'network'
             raise NetworkRetryableError(
                 'A network error caused the failure of the job: '
                 '%s' % err)
         except xmlrpclib.ProtocolError as err:
+            fault = 'http %d' % err.errcode
             if err.errcode in [502,   # Bad gateway
                                503,   # Service unavailable
                                504]:  # Gateway timeout
@@ -176,6 +376,146 @@ class MagentoCRUDAdapter(CRUDAdapter):
                     (err.url, err.headers, err.errcode, err.errmsg))
             else:
                 raise
+        except Exception:
+            fault = ERROR_FAULT
+            raise
+        finally:
+            duration = time.time() - start
+            circuit_breaker.after_call(dbname, backend.id, fault=fault)
+            rate_limiter.release(dbname, backend.id, slot, duration,
+                                 fault=fault)
+            api_stats.record(dbname, backend.id, method, duration,
+                             size=payload_size(result), fault=fault)
+
+    def _call(self, method, arguments):
+        if self._collected_calls is not None:
+            # collected by a MagentoBatch, sent later in a multiCall
+            self._collected_calls.append((method, arguments))
+            return
+        if self._batch_responses:
+            key = call_to_key(method, arguments)
+            if key in self._batch_responses:
+                result = self._batch_responses.pop(key)
+                if isinstance(result, xmlrpclib.Fault):
+                    raise result
+                return result
+        result = self._execute(lambda api: api.call(method, arguments),
+                               method=method)
+        # Uncomment to record requests/responses in ``recorder``
+        # record(method, arguments, result)
+        _logger.debug("api.call(%s, %s) returned %s",
+                      method, arguments, result)
+        return result
+
+    def _multi_call(self, calls):
+        """ Send several calls in one ``multiCall`` request
+
+        :param calls: list of ``(method, arguments)``
+        :return: list with the result of each call, in the same order,
+                 a failed call gives an ``xmlrpclib.Fault`` instance
+        """
+        calls = [[method, arguments] for method, arguments in calls]
+        results = self._execute(lambda api: api.multiCall(calls),
+                                method='multiCall')
+        _logger.debug("api.multiCall(%s) returned %s", calls, results)
+        responses = []
+        for result in results:
+            if isinstance(result, dict) and result.get('isFault'):
+                result = xmlrpclib.Fault(int(result['faultCode']),
+                                         result.get('faultMessage'))
+            responses.append(result)
+        return responses
+
+
+class BatchCall(object):
+    """ A call collected by a :class:`MagentoBatch` """
+
+    def __init__(self, batch, func, args, kwargs, method, arguments):
+        self.batch = batch
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.method = method
+        self.arguments = arguments
+        self.done = False
+        self.response = None
+
+    def result(self):
+        """ Return the result of the call or raise its error
+
+        The function given to :meth:`MagentoBatch.add` is called again,
+        its call to Magento being answered by the response of the
+        ``multiCall``, so the errors are raised by the adapter the
+        same way than for a single call (``IDMissingInBackend``, ...).
+        """
+        if not self.done:
+            self.batch.flush()
+        responses = self.batch.adapter._batch_responses
+        key = call_to_key(self.method, self.arguments)
+        responses[key] = self.response
+        try:
+            return self.func(*self.args, **self.kwargs)
+        finally:
+            responses.pop(key, None)
+
+
+class MagentoBatch(object):
+    """ Send the calls of an adapter by packets with ``multiCall``
+
+    Instead of one request per call, the calls are collected and sent
+    together in one ``multiCall`` request each time ``size`` calls are
+    collected or when :meth:`flush` is called.
+
+    Usage::
+
+        batch = adapter.batch()
+        calls = [(magento_id, batch.add(adapter.read, magento_id))
+                 for magento_id in magento_ids]
+        for magento_id, call in calls:
+            try:
+                record = call.result()
+            except IDMissingInBackend:
+                # only this record is missing
+                continue
+
+    ``func`` can be any callable doing exactly one call to Magento
+    through the adapter of the batch (usually a method of the adapter).
+    """
+
+    def __init__(self, adapter, size=DEFAULT_BATCH_SIZE):
+        self.adapter = adapter
+        self.size = size
+        self._pending = []
+
+    def add(self, func, *args, **kwargs):
+        """ Collect a call, return a :class:`BatchCall` """
+        adapter = self.adapter
+        collected = adapter._collected_calls = []
+        try:
+            func(*args, **kwargs)
+        finally:
+            adapter._collected_calls = None
+        if len(collected) != 1:
+            raise ValueError('%s did %d calls to Magento, only the '
+                             'functions doing exactly 1 call can be '
+                             'batched' % (func, len(collected)))
+        method, arguments = collected[0]
+        call = BatchCall(self, func, args, kwargs, method, arguments)
+        self._pending.append(call)
+        if len(self._pending) >= self.size:
+            self.flush()
+        return call
+
+    def flush(self):
+        """ Send the collected calls """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        responses = self.adapter._multi_call(
+            [(call.method, call.arguments) for call in pending])
+        for call, response in zip(pending, responses):
+            call.response = response
+            call.done = True
 
 
 class GenericAdapter(MagentoCRUDAdapter):
@@ -183,6 +523,8 @@ class GenericAdapter(MagentoCRUDAdapter):
     _model_name = None
     _magento_model = None
     _admin_path = None
+    # field used to paginate the searches in ``iter_search``
+    _id_field = None
 
     def search(self, filters=None):
         """ Search records according to some criterias
@@ -193,6 +535,40 @@ class GenericAdapter(MagentoCRUDAdapter):
         return self._call('%s.search' % self._magento_model,
                           [filters] if filters else [{}])
 
+    def iter_search(self, filters=None, page_size=DEFAULT_PAGE_SIZE,
+                    max_id=None, **kwargs):
+        """ Search records and yield their ids
+
+        When the highest id of the records is known (``max_id``) and no
+        date bounds the search, the records are searched page by page:
+        each page is a window of ``page_size`` values of ``_id_field``
+        (``from`` / ``to``), so Magento never has to build the whole
+        list in one response.  The Magento API gives no way to find the
+        highest id, so it is given by the callers which know it.
+
+        Otherwise, or without ``_id_field``, a single :meth:`search` is
+        done.
+
+        The keyword arguments are given to :meth:`search`.
+        """
+        filters = filters or {}
+        dated = (kwargs.get('from_date') or
+                 DATE_FILTER_FIELDS.intersection(filters))
+        if (not max_id or dated or self._id_field is None or
+                self._id_field in filters):
+            for record_id in self.search(dict(filters), **kwargs):
+                yield record_id
+            return
+        last_id = 0
+        while last_id < max_id:
+            page_filters = dict(filters)
+            page_filters[self._id_field] = {
+                'from': last_id + 1,
+                'to': min(last_id + page_size, max_id)}
+            for record_id in self.search(page_filters, **kwargs):
+                yield record_id
+            last_id += page_size
+
     def read(self, id, attributes=None):
         """ Returns the information of a record
 
@@ -230,6 +606,45 @@ class GenericAdapter(MagentoCRUDAdapter):
         """ Delete a record on the external system """
         return self._call('%s.delete' % self._magento_model, [int(id)])
 
+    def read_concurrently(self, ids, workers=DEFAULT_READ_WORKERS):
+        """ Read records with parallel requests
+
+        Each request uses its own session from the pool of sessions.
+        This is a prefetch: the records which could not be read are
+        not returned, reading them again with :meth:`read` will raise
+        the error.
+
+        :param ids: ids of the records to read
+        :param workers: maximum number of parallel requests
+        :return: dict with the ids as keys and the records as values
+        :rtype: dict
+        """
+        def read(id):
+            try:
+                return id, self.read(id)
+            except Exception:
+                _logger.debug('prefetch of %s %s failed',
+                              self._magento_model, id, exc_info=True)
+                return id, None
+
+        ids = list(ids)
+        if len(ids) <= 1 or workers <= 1:
+            results = [read(id) for id in ids]
+        else:
+            pool = ThreadPool(min(workers, len(ids)))
+            try:
+                results = pool.map(read, ids)
+            finally:
+                pool.close()
+                pool.join()
+        return dict((id, record) for id, record in results
+                    if record is not None)
+
+    def batch(self, size=DEFAULT_BATCH_SIZE):
+        """ Return a :class:`MagentoBatch` grouping the calls of this
+        adapter in ``multiCall`` requests """
+        return MagentoBatch(self, size=size)
+
     def admin_url(self, id):
         """ Return the URL in the Magento admin for a record """
         if self._admin_path is None:
@@ -19,12 +19,84 @@
 #
 ##############################################################################
 
+import weakref
 from datetime import datetime
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.connector import Binder
 from ..backend import magento
 
 
+class BindingCache(object):
+    """ Bindings of a model and a backend already read in a transaction
+
+    Keeps the links between the Magento IDs, the bindings and the
+    OpenERP records, so the binders do not search them again.
+    """
+
+    def __init__(self):
+        self.binding_by_external = {}  # magento id -> binding id
+        self.external_by_binding = {}  # binding id -> magento id
+        self.openerp_by_binding = {}  # binding id -> openerp id
+        self.binding_by_openerp = {}  # openerp id -> binding id
+
+    def add(self, binding_id, external_id, openerp_id=None):
+        self.remove(binding_id)
+        if external_id:
+            self.binding_by_external[str(external_id)] = binding_id
+        self.external_by_binding[binding_id] = external_id
+        if openerp_id is not None:
+            self.openerp_by_binding[binding_id] = openerp_id
+            self.binding_by_openerp[openerp_id] = binding_id
+
+    def remove(self, binding_id):
+        external_id = self.external_by_binding.pop(binding_id, None)
+        if external_id:
+            self.binding_by_external.pop(str(external_id), None)
+        openerp_id = self.openerp_by_binding.pop(binding_id, None)
+        if openerp_id is not None:
+            self.binding_by_openerp.pop(openerp_id, None)
+
+
+# {cursor: {(model name, backend id): BindingCache}}
+# the cache lives as long as the cursor, so it is scoped to
+# the transaction
+_binding_caches = weakref.WeakKeyDictionary()
+
+
+def get_binding_cache(cr, model_name, backend_id):
+    """ Return the :class:`BindingCache` of a model and a backend for
+    the transaction of a cursor """
+    caches = _binding_caches.setdefault(cr, {})
+    key = (model_name, backend_id)
+    if key not in caches:
+        caches[key] = BindingCache()
+    return caches[key]
+
+
+def invalidate_binding_cache(cr, model_name=None, binding_ids=None):
+    """ Empty the bindings cache of a cursor
+
+    :param model_name: if given, only the bindings of this model are
+                       dropped
+    :param binding_ids: if given, only these bindings of the model are
+                        dropped
+    """
+    caches = _binding_caches.get(cr)
+    if not caches:
+        return
+    if model_name is None:
+        caches.clear()
+        return
+    for key in caches.keys():
+        if key[0] != model_name:
+            continue
+        if binding_ids is None:
+            del caches[key]
+        else:
+            for binding_id in binding_ids:
+                caches[key].remove(binding_id)
+
+
 class MagentoBinder(Binder):
     """ Generic Binder for Magento """
 
@@ -55,6 +127,71 @@ class MagentoModelBinder(MagentoBinder):
         'magento.account.invoice',
     ]
 
+    @property
+    def _cache(self):
+        return get_binding_cache(self.session.cr,
+                                 self.model._name,
+                                 self.backend_record.id)
+
+    def _has_openerp_id(self):
+        return 'openerp_id' in self.model._columns
+
+    def _read_bindings(self, binding_ids):
+        """ Read the bindings and put them in the cache """
+        fields = ['magento_id']
+        if self._has_openerp_id():
+            fields.append('openerp_id')
+        sess = self.session
+        bindings = self.model.read(sess.cr, sess.uid, binding_ids, fields,
+                                   context=sess.context,
+                                   load='_classic_write')
+        cache = self._cache
+        for binding in bindings:
+            cache.add(binding['id'], binding['magento_id'],
+                      openerp_id=binding.get('openerp_id'))
+        return bindings
+
+    def to_openerp_many(self, external_ids, unwrap=False):
+        """ Give the OpenERP IDs for a list of external IDs
+
+        The bindings which are not yet known in the transaction are
+        read with one search, so it should be preferred to
+        :meth:`to_openerp` when many IDs have to be found.
+
+        :param external_ids: external IDs for which we want the OpenERP IDs
+        :param unwrap: if True, returns the openerp_id of the magento_xxxx
+                       records, else return the ids (binding ids) of
+                       the records
+        :return: list of record IDs in the same order than
+                 ``external_ids``, None for the external IDs which are
+                 not mapped
+        :rtype: list
+        """
+        cache = self._cache
+        external_ids = [str(external_id) for external_id in external_ids]
+        missing = set(external_id for external_id in external_ids
+                      if external_id not in cache.binding_by_external)
+        if missing:
+            with self.session.change_context({'active_test': False}):
+                binding_ids = self.session.search(
+                    self.model._name,
+                    [('magento_id', 'in', list(missing)),
+                     ('backend_id', '=', self.backend_record.id)])
+            bindings = self._read_bindings(binding_ids)
+            found = [binding['magento_id'] for binding in bindings]
+            assert len(found) == len(set(found)), (
+                "Several records found: %s" % binding_ids)
+        result = []
+        for external_id in external_ids:
+            binding_id = cache.binding_by_external.get(external_id)
+            if binding_id is not None and unwrap:
+                if binding_id not in cache.openerp_by_binding:
+                    self._read_bindings([binding_id])
+                result.append(cache.openerp_by_binding[binding_id])
+            else:
+                result.append(binding_id)
+        return result
+
     def to_openerp(self, external_id, unwrap=False):
         """ Give the OpenERP ID for an external ID
 
@@ -65,21 +202,7 @@ class MagentoModelBinder(MagentoBinder):
                  or None if the external_id is not mapped
         :rtype: int
         """
-        with self.session.change_context({'active_test': False}):
-            binding_ids = self.session.search(
-                self.model._name,
-                [('magento_id', '=', str(external_id)),
-                 ('backend_id', '=', self.backend_record.id)])
-        if not binding_ids:
-            return None
-        assert len(binding_ids) == 1, "Several records found: %s" % binding_ids
-        binding_id = binding_ids[0]
-        if unwrap:
-            return self.session.read(self.model._name,
-                                     binding_id,
-                                     ['openerp_id'])['openerp_id'][0]
-        else:
-            return binding_id
+        return self.to_openerp_many([external_id], unwrap=unwrap)[0]
 
     def to_backend(self, record_id, wrap=False):
         """ Give the external ID for an OpenERP ID
@@ -91,42 +214,52 @@ class MagentoModelBinder(MagentoBinder):
             the backend id of the binding
         :return: backend identifier of the record
         """
+        cache = self._cache
         if wrap:
-            with self.session.change_context({'active_test': False}):
-                erp_id = self.session.search(
-                    self.model._name,
-                    [('openerp_id', '=', record_id),
-                     ('backend_id', '=', self.backend_record.id)
-                     ])
-            if erp_id:
-                record_id = erp_id[0]
+            if record_id in cache.binding_by_openerp:
+                record_id = cache.binding_by_openerp[record_id]
             else:
-                return None
-        magento_record = self.session.read(self.model._name,
-                                           record_id,
-                                           ['magento_id'])
-        assert magento_record
-        return magento_record['magento_id']
-
-    def bind(self, external_id, binding_id):
+                with self.session.change_context({'active_test': False}):
+                    erp_id = self.session.search(
+                        self.model._name,
+                        [('openerp_id', '=', record_id),
+                         ('backend_id', '=', self.backend_record.id)
+                         ])
+                if erp_id:
+                    record_id = erp_id[0]
+                else:
+                    return None
+        if record_id not in cache.external_by_binding:
+            magento_record = self._read_bindings([record_id])
+            assert magento_record
+        return cache.external_by_binding[record_id]
+
+    def bind(self, external_id, binding_id, magento_hash=False):
         """ Create the link between an external ID and an OpenERP ID and
         update the last synchronization date.
 
         :param external_id: External ID to bind
         :param binding_id: OpenERP ID to bind
         :type binding_id: int
+        :param magento_hash: digest of the imported Magento data, emptied
+                             when not given (exports)
+        :type magento_hash: str
         """
         # avoid to trigger the export when we modify the `magento_id`
         context = self.session.context.copy()
         context['connector_no_export'] = True
         now_fmt = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cache = self._cache
+        openerp_id = cache.openerp_by_binding.get(binding_id)
         self.environment.model.write(
             self.session.cr,
             self.session.uid,
             binding_id,
             {'magento_id': str(external_id),
-             'sync_date': now_fmt},
+             'sync_date': now_fmt,
+             'magento_hash': magento_hash},
             context=context)
+        cache.add(binding_id, str(external_id), openerp_id=openerp_id)
 
     def unwrap_binding(self, binding_id, browse=False):
         """ For a binding record, gives the normal record.
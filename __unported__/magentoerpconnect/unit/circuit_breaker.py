@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Circuit breaker for the Magento backends.
+
+When a backend fails with network or server errors on consecutive calls,
+its circuit is opened: the following calls fail immediately with
+:class:`~openerp.addons.magentoerpconnect.exception.BackendUnavailable`
+instead of waiting for the timeouts, so their jobs are postponed.
+
+After a delay, one call is let through to probe the backend (half-open
+circuit): the circuit is closed if it succeeds, otherwise it is opened
+again for a doubled delay.  A probe which could not be sent (no slot
+given by the rate limiter) is cancelled, so the next call probes.
+
+The network errors, the HTTP 5xx errors and the unexpected errors of the
+calls are failures; a fault returned by Magento means that it answered.
+
+The state of the circuits is kept per process.
+
+"""
+
+import logging
+import threading
+import time
+
+from ..exception import BackendUnavailable
+from .rate_limiter import is_overload_fault
+
+_logger = logging.getLogger(__name__)
+
+# Number of consecutive failed calls opening the circuit
+FAILURE_THRESHOLD = 5
+# Delay (in seconds) before probing an opened circuit, doubled after each
+# failed probe up to ``MAX_RESET_TIMEOUT``
+RESET_TIMEOUT = 30
+MAX_RESET_TIMEOUT = 600
+# A probe is considered lost (and another one is allowed) after this delay
+PROBE_TIMEOUT = 120
+
+# Fault of the calls failing with an unexpected error
+ERROR_FAULT = 'error'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Circuit(object):
+    """ State of the circuit of a backend """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.reset_timeout = RESET_TIMEOUT
+        self.opened_at = 0.
+        self.probe_started_at = 0.
+
+
+class CircuitBreaker(object):
+    """ Circuit breakers of the Magento backends of the current process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def circuit(self, dbname, backend_id):
+        with self._lock:
+            key = (dbname, backend_id)
+            if key not in self._circuits:
+                self._circuits[key] = Circuit()
+            return self._circuits[key]
+
+    def before_call(self, dbname, backend_id):
+        """ Check if a call can be done on the backend
+
+        :return: True when the call is the probe of the backend, it must
+                 be given to :meth:`cancel_probe` if it is not sent
+        :raise: :class:`BackendUnavailable` when the circuit is open
+        """
+        circuit = self.circuit(dbname, backend_id)
+        with self._lock:
+            now = time.time()
+            if circuit.state == CLOSED:
+                return False
+            elif circuit.state == OPEN:
+                if now - circuit.opened_at >= circuit.reset_timeout:
+                    circuit.state = HALF_OPEN
+                    circuit.probe_started_at = now
+                    _logger.info('Probing the Magento backend %s',
+                                 backend_id)
+                    return True
+                retry_in = circuit.reset_timeout - (now - circuit.opened_at)
+            else:  # half-open, a probe is running
+                if now - circuit.probe_started_at >= PROBE_TIMEOUT:
+                    circuit.probe_started_at = now
+                    return True
+                retry_in = PROBE_TIMEOUT - (now - circuit.probe_started_at)
+        raise BackendUnavailable(
+            'The Magento backend failed on the last %d calls, no call '
+            'will be done on it for %d seconds. The job will be '
+            'retried later.' % (circuit.failures, retry_in))
+
+    def cancel_probe(self, dbname, backend_id):
+        """ Forget a probe which has not been sent, the next call will
+        probe the backend """
+        circuit = self.circuit(dbname, backend_id)
+        with self._lock:
+            if circuit.state == HALF_OPEN:
+                circuit.state = OPEN
+                circuit.opened_at = time.time() - circuit.reset_timeout
+
+    def after_call(self, dbname, backend_id, fault=None):
+        """ Update the circuit of the backend with the result of a call """
+        circuit = self.circuit(dbname, backend_id)
+        with self._lock:
+            if is_overload_fault(fault) or fault == ERROR_FAULT:
+                circuit.failures += 1
+                if circuit.state == HALF_OPEN:
+                    circuit.reset_timeout = min(MAX_RESET_TIMEOUT,
+                                                circuit.reset_timeout * 2)
+                elif (circuit.state == CLOSED and
+                        circuit.failures < FAILURE_THRESHOLD):
+                    return
+                elif circuit.state == OPEN:
+                    # a call which started before the opening
+                    return
+                circuit.state = OPEN
+                circuit.opened_at = time.time()
+                _logger.warning('Magento backend %s unavailable after %d '
+                                'failures, its calls are suspended for '
+                                '%d seconds', backend_id, circuit.failures,
+                                circuit.reset_timeout)
+            else:
+                # the backend answered, even with a fault
+                if circuit.state != CLOSED:
+                    _logger.info('Magento backend %s available again',
+                                 backend_id)
+                circuit.state = CLOSED
+                circuit.failures = 0
+                circuit.reset_timeout = RESET_TIMEOUT
+
+
+circuit_breaker = CircuitBreaker()
+""" Circuit breakers of the current process """
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Download of the images from Magento.
+
+The HTTP connections are kept alive and reused between the downloads,
+the number of simultaneous downloads per host is bounded, and the
+downloads can be conditional (``ETag`` / ``Last-Modified``) so an image
+which did not change is not downloaded again.
+
+"""
+
+import httplib
+import logging
+import socket
+import threading
+import urllib2
+import urlparse
+from collections import namedtuple
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of simultaneous downloads (and open connections) per host
+DEFAULT_MAX_CONNECTIONS = 4
+# Timeout (in seconds) of the connections
+DEFAULT_TIMEOUT = 60
+# Maximum number of redirections followed for a download
+MAX_REDIRECTS = 5
+
+ImageResponse = namedtuple('ImageResponse',
+                           'url data etag last_modified not_modified')
+""" Result of a download.
+
+``not_modified`` is True when the server answered that the image did
+not change since the ``etag`` / ``last_modified`` given to the download;
+``data`` is then None.
+"""
+
+
+class ImageDownloader(object):
+    """ Download images with a pool of keep-alive HTTP connections.
+
+    A module-level instance, ``image_downloader``, is shared by the
+    importers.  It is thread-safe: each download takes a connection
+    from the pool, waiting if ``max_connections`` downloads are already
+    running for the host.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(
+                    self.max_connections)
+            return self._slots[key]
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        """ Return an idle connection for the host or a new one """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _release(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def clear(self):
+        """ Close all the idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, headers):
+        """ Send a GET request on a connection of the pool
+
+        :return: status, response headers (lowercase), body
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self._slot(key):
+            connection, reused = self._acquire(key)
+            try:
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                except (httplib.BadStatusLine, socket.error):
+                    if not reused:
+                        raise
+                    # the server closed the idle connection, retry on
+                    # a new connection
+                    connection.close()
+                    connection = self._connect(key)
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                body = response.read()
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+        response_headers = dict((name.lower(), value) for name, value
+                                in response.getheaders())
+        return response.status, response.reason, response_headers, body
+
+    def download(self, url, headers=None, etag=None, last_modified=None):
+        """ Download an image
+
+        :param url: url of the image
+        :param headers: additional headers (authentication, ...)
+        :param etag: ``ETag`` of the last download of the image, the
+                     image is not downloaded if it did not change
+        :param last_modified: ``Last-Modified`` of the last download of
+                              the image, used like ``etag``
+        :return: an :class:`ImageResponse`, None if the image does not
+                 exist (404)
+        :raise: :class:`urllib2.HTTPError` on other HTTP errors
+        """
+        request_headers = dict(headers or {})
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+        netloc = urlparse.urlsplit(url).netloc
+        for __ in xrange(MAX_REDIRECTS + 1):
+            status, reason, response_headers, body = self._request(
+                url, request_headers)
+            if status in (301, 302, 303, 307) and \
+                    response_headers.get('location'):
+                url = urlparse.urljoin(url, response_headers['location'])
+                if urlparse.urlsplit(url).netloc != netloc:
+                    # do not give the credentials to another host
+                    request_headers = dict(
+                        (name, value) for name, value
+                        in request_headers.iteritems()
+                        if name.lower() != 'authorization')
+                continue
+            break
+        if status == 304:
+            _logger.debug('image %s not modified', url)
+            return ImageResponse(url, None, etag, last_modified, True)
+        if status == 404:
+            # the image is just missing
+            return None
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(url, status, reason,
+                                    response_headers, None)
+        return ImageResponse(url, body,
+                             response_headers.get('etag'),
+                             response_headers.get('last-modified'),
+                             False)
+
+
+image_downloader = ImageDownloader()
@@ -19,16 +19,31 @@
 #
 ##############################################################################
 
+import base64
+import hashlib
+import json
 import logging
+import xmlrpclib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+
+import psycopg2
+
 from openerp.tools.translate import _
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.queue.job import job, related_action
 from openerp.addons.connector.connector import ConnectorUnit
 from openerp.addons.connector.unit.synchronizer import ImportSynchronizer
-from openerp.addons.connector.exception import IDMissingInBackend
+from openerp.addons.connector.unit.backend_adapter import BackendAdapter
+from openerp.addons.connector.exception import (IDMissingInBackend,
+                                                RetryableJobError)
 from ..backend import magento
-from ..connector import get_environment, add_checkpoint
+from ..connector import get_environment, add_checkpoint, backend_config
+from .backend_adapter import TRANSPORT_ERRORS
+from .binder import invalidate_binding_cache
+from .worker_cache import WorkerCache
 from ..related_action import link
 
 _logger = logging.getLogger(__name__)
@@ -38,7 +53,8 @@ _logger = logging.getLogger(__name__)
 Importers for Magento.
 
 An import can be skipped if the last sync date is more recent than
-the last update in Magento.
+the last update in Magento, or if the Magento data is the same than
+the last time it was imported.
 
 They should call the ``bind`` method if the binder even if the records
 are already bound, to update the last sync date.
@@ -46,6 +62,15 @@ are already bound, to update the last sync date.
 """
 
 
+def json_default(value):
+    """ Serialize the XML-RPC values of the Magento data in JSON """
+    if isinstance(value, xmlrpclib.DateTime):
+        return str(value)
+    elif isinstance(value, xmlrpclib.Binary):
+        return base64.b64encode(value.data)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
 class MagentoImportSynchronizer(ImportSynchronizer):
     """ Base importer for Magento """
 
@@ -57,11 +82,27 @@ class MagentoImportSynchronizer(ImportSynchronizer):
         super(MagentoImportSynchronizer, self).__init__(environment)
         self.magento_id = None
         self.magento_record = None
+        self.prefetched_record = None
+        # when a list, the translations to import are collected in it
+        # instead of being delayed in a job per record
+        self.collected_translations = None
 
     def _get_magento_data(self):
         """ Return the raw Magento data for ``self.magento_id`` """
+        if self.prefetched_record is not None:
+            return self.prefetched_record
         return self.backend_adapter.read(self.magento_id)
 
+    def is_current(self, record):
+        """ Return True if ``record``, the data of the record read before
+        the import, are still the current data on Magento
+
+        Used to import the data read by a batch import without reading
+        the record again.  By default, the data are never considered as
+        current.
+        """
+        return False
+
     def _before_import(self):
         """ Hook called before the import, when we have the Magento
         data"""
@@ -90,6 +131,21 @@ class MagentoImportSynchronizer(ImportSynchronizer):
         # miss changes done in Magento
         return magento_date < sync_date
 
+    def _hash_magento_record(self):
+        """ Return a digest of the Magento data """
+        data = json.dumps(self.magento_record, sort_keys=True,
+                          default=json_default)
+        return hashlib.sha1(data).hexdigest()
+
+    def _is_unchanged(self, binding_id, magento_hash):
+        """Return True if the import should be skipped because the
+        Magento data is the same than the last time it was imported"""
+        if not binding_id:
+            return False
+        binding = self.session.read(self.model._name, binding_id,
+                                    ['magento_hash'])
+        return binding['magento_hash'] == magento_hash
+
     def _import_dependency(self, magento_id, binding_model,
                            importer_class=None, always=False):
         """ Import a dependency.
@@ -123,6 +179,45 @@ class MagentoImportSynchronizer(ImportSynchronizer):
                 importer_class, model=binding_model)
             importer.run(magento_id)
 
+    def _import_dependencies_many(self, magento_ids, binding_model,
+                                  importer_class=None):
+        """ Import the missing dependencies of a list of records.
+
+        The bindings are searched with one query. The Magento records
+        which are not yet imported are read with parallel requests,
+        then they are imported one by one.
+
+        :param magento_ids: ids of the related bindings to import
+        :param binding_model: name of the binding model for the relation
+        :type binding_model: str | unicode
+        :param importer_class: :class:`openerp.addons.connector.\
+                                       connector.ConnectorUnit`
+                               class or parent class to use for the import.
+                               By default: MagentoImportSynchronizer
+        """
+        magento_ids = [magento_id for magento_id
+                       in OrderedDict.fromkeys(magento_ids) if magento_id]
+        if not magento_ids:
+            return
+        if importer_class is None:
+            importer_class = MagentoImportSynchronizer
+        binder = self.get_binder_for_model(binding_model)
+        binding_ids = binder.to_openerp_many(magento_ids)
+        missing_ids = [magento_id for magento_id, binding_id
+                       in zip(magento_ids, binding_ids)
+                       if binding_id is None]
+        if not missing_ids:
+            return
+        adapter = self.get_connector_unit_for_model(BackendAdapter,
+                                                    binding_model)
+        records = adapter.read_concurrently(missing_ids)
+        for magento_id in missing_ids:
+            importer = self.get_connector_unit_for_model(
+                importer_class, model=binding_model)
+            # when the prefetch failed, the record is read again by
+            # the importer
+            importer.run(magento_id, record=records.get(magento_id))
+
     def _import_dependencies(self):
         """ Import the dependencies for the record
 
@@ -196,12 +291,34 @@ class MagentoImportSynchronizer(ImportSynchronizer):
         """ Hook called at the end of the import """
         return
 
-    def run(self, magento_id, force=False):
+    def _import_translations(self, binding_id, mapper_class=None):
+        """ Delay the import of the translations of the record
+
+        When the record is imported in a chunk, the translations are
+        imported in a job for the whole chunk (see
+        :class:`RecordChunkImport`).
+        """
+        if self.collected_translations is not None:
+            self.collected_translations.append(
+                (self.magento_id, binding_id, mapper_class))
+            return
+        import_translations.delay(self.session,
+                                  self.model._name,
+                                  self.backend_record.id,
+                                  self.magento_id,
+                                  binding_id,
+                                  mapper_class=mapper_class,
+                                  priority=TRANSLATION_IMPORT_PRIORITY)
+
+    def run(self, magento_id, force=False, record=None):
         """ Run the synchronization
 
         :param magento_id: identifier of the record on Magento
+        :param record: Magento data of the record when it has already
+                       been read, it will not be read again
         """
         self.magento_id = magento_id
+        self.prefetched_record = record
         try:
             self.magento_record = self._get_magento_data()
         except IDMissingInBackend:
@@ -215,7 +332,15 @@ class MagentoImportSynchronizer(ImportSynchronizer):
 
         if not force and self._is_uptodate(binding_id):
             return _('Already up-to-date.')
+        # even when forced, an import of the same data is useless
+        magento_record = self.magento_record
+        magento_hash = self._hash_magento_record()
+        if self._is_unchanged(binding_id, magento_hash):
+            return _('Already up-to-date (same data on Magento).')
         self._before_import()
+        if self.magento_record is not magento_record:
+            # read again by ``_before_import``
+            magento_hash = self._hash_magento_record()
 
         # import the missing linked resources
         self._import_dependencies()
@@ -229,7 +354,8 @@ class MagentoImportSynchronizer(ImportSynchronizer):
             record = self._create_data(map_record)
             binding_id = self._create(record)
 
-        self.binder.bind(self.magento_id, binding_id)
+        self.binder.bind(self.magento_id, binding_id,
+                         magento_hash=magento_hash)
 
         self._after_import(binding_id)
 
@@ -242,9 +368,25 @@ class BatchImportSynchronizer(ImportSynchronizer):
 
     def run(self, filters=None):
         """ Run the synchronization """
-        record_ids = self.backend_adapter.search(filters)
+        adapter = self.backend_adapter
+        if hasattr(adapter, 'iter_search'):
+            record_ids = adapter.iter_search(filters)
+        else:
+            record_ids = adapter.search(filters)
+        self._import_records(record_ids)
+
+    def _import_records(self, record_ids):
+        """ Import a list of records directly or delay their import
+
+        ``record_ids`` can be a generator, it is consumed lazily.
+
+        :return: number of records
+        """
+        count = 0
         for record_id in record_ids:
             self._import_record(record_id)
+            count += 1
+        return count
 
     def _import_record(self, record_id):
         """ Import a record directly or delay the import of the record.
@@ -267,17 +409,204 @@ class DirectBatchImport(BatchImportSynchronizer):
 
 
 class DelayedBatchImport(BatchImportSynchronizer):
-    """ Delay import of the records """
+    """ Delay import of the records
+
+    By default, a job is delayed for each record. When
+    ``_chunk_size_field`` is the name of a field of the backend and
+    this field has a value greater than 1, the records are grouped in
+    chunks and a job imports a whole chunk (see
+    :class:`RecordChunkImport`).
+    """
     _model_name = None
+    _chunk_size_field = None
+
+    def _chunk_size(self):
+        """ Number of records to import per job """
+        if self._chunk_size_field is None:
+            return 1
+        return getattr(self.backend_record, self._chunk_size_field) or 1
+
+    def _import_records(self, record_ids):
+        """ Delay the import of the records, one job per record or per
+        chunk of records """
+        chunk_size = self._chunk_size()
+        if chunk_size <= 1:
+            return super(DelayedBatchImport, self)._import_records(record_ids)
+        count = 0
+        record_ids = iter(record_ids)
+        while True:
+            chunk = list(islice(record_ids, chunk_size))
+            if not chunk:
+                return count
+            self._import_chunk(chunk)
+            count += len(chunk)
 
     def _import_record(self, record_id, **kwargs):
-        """ Delay the import of the records"""
-        import_record.delay(self.session,
+        """ Delay the import of the records
+
+        When the backend stages the imports, the job only reads the
+        record and stores its data, another job imports it. When the
+        data of the record are given (``record``), they are stored
+        right away and the job receives the id of the stored data.
+        """
+        record = kwargs.pop('record', None)
+        staging = backend_config(self.environment).use_import_staging
+        if record is None:
+            job_func = fetch_record if staging else import_record
+            job_func.delay(self.session,
+                           self.model._name,
+                           self.backend_record.id,
+                           record_id,
+                           **kwargs)
+            return
+        session = self.session
+        payload_obj = session.pool['magento.import.payload']
+        payload_id = payload_obj.store(session.cr, session.uid,
+                                       self.backend_record.id,
+                                       self.model._name,
+                                       record_id,
+                                       record,
+                                       context=session.context)
+        if not staging:
+            import_record.delay(session,
+                                self.model._name,
+                                self.backend_record.id,
+                                record_id,
+                                payload_id=payload_id,
+                                **kwargs)
+            return
+        apply_payload.delay(session,
                             self.model._name,
                             self.backend_record.id,
-                            record_id,
+                            payload_id,
                             **kwargs)
 
+    def _import_chunk(self, record_ids, **kwargs):
+        """ Delay the import of a chunk of records """
+        import_record_chunk.delay(self.session,
+                                  self.model._name,
+                                  self.backend_record.id,
+                                  record_ids,
+                                  **kwargs)
+
+
+@contextmanager
+def savepoint(cr, name):
+    """ Execute the block in a savepoint, rollbacked on errors """
+    cr.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cr.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # the bindings created in the savepoint no longer exist
+        invalidate_binding_cache(cr)
+        raise
+    else:
+        cr.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+def find_or_create(cr, uid, model, domain, vals, context=None):
+    """ Return the id of the record matching ``domain``, created with
+    ``vals`` when there is none
+
+    When a concurrent transaction has created the record meanwhile (a
+    unique constraint fails), the record is not visible in the current
+    transaction: a :class:`RetryableJobError` is raised, the job will
+    find it when it is retried.
+
+    :param model: the model (``self.pool[...]``)
+    """
+    record_ids = model.search(cr, uid, domain, limit=1, context=context)
+    if record_ids:
+        return record_ids[0]
+    try:
+        with savepoint(cr, 'magento_find_or_create'):
+            return model.create(cr, uid, vals, context=context)
+    except psycopg2.IntegrityError:
+        raise RetryableJobError(
+            'A record of %s has been created by a concurrent '
+            'transaction, the job will be retried.' % model._name)
+
+
+@magento
+class RecordChunkImport(ImportSynchronizer):
+    """ Import a chunk of records in one job.
+
+    The Magento records are read together in ``multiCall`` requests,
+    then each of them is imported with the importer of the model in its
+    own savepoint. When the import of a record fails, it is rollbacked
+    and a job is delayed to import this record alone, the other records
+    of the chunk are still imported.
+    """
+    _model_name = ['magento.product.product',
+                   'magento.product.category',
+                   'magento.res.partner',
+                   ]
+
+    def run(self, magento_ids, force=False):
+        """ Run the synchronization
+
+        :param magento_ids: identifiers of the records on Magento
+        """
+        adapter = self.backend_adapter
+        batch = adapter.batch()
+        reads = [(magento_id, batch.add(adapter.read, magento_id))
+                 for magento_id in magento_ids]
+        batch.flush()
+        get_importer = self.environment.get_connector_unit
+        failed_ids = []
+        translations = []
+        for magento_id, read in reads:
+            try:
+                record = read.result()
+            except IDMissingInBackend:
+                continue
+            importer = get_importer(MagentoImportSynchronizer)
+            importer.collected_translations = []
+            try:
+                with savepoint(self.session.cr, 'magento_chunk_import'):
+                    importer.run(magento_id, force=force, record=record)
+            except (RetryableJobError,) + TRANSPORT_ERRORS:
+                # Magento is not available, the whole chunk is retried
+                raise
+            except Exception:
+                _logger.exception('Import of %s %s failed, a job is '
+                                  'created to import it again',
+                                  self.model._name, magento_id)
+                failed_ids.append(magento_id)
+            else:
+                translations += importer.collected_translations
+        self._import_translations(translations)
+        for magento_id in failed_ids:
+            import_record.delay(self.session,
+                                self.model._name,
+                                self.backend_record.id,
+                                magento_id,
+                                force=force)
+        if failed_ids:
+            return _('%d records imported, a new job has been created for '
+                     'the failed records: %s') % (
+                len(magento_ids) - len(failed_ids), failed_ids)
+
+    def _import_translations(self, translations):
+        """ Delay a job importing the translations of the chunk
+
+        :param translations: list of tuples (magento id, binding id,
+                             mapper class)
+        """
+        records_by_mapper = {}
+        for magento_id, binding_id, mapper_class in translations:
+            records = records_by_mapper.setdefault(mapper_class, [])
+            records.append((magento_id, binding_id))
+        for mapper_class, records in records_by_mapper.iteritems():
+            import_translations_batch.delay(
+                self.session,
+                self.model._name,
+                self.backend_record.id,
+                records,
+                mapper_class=mapper_class,
+                priority=TRANSLATION_IMPORT_PRIORITY)
+
 
 @magento
 class SimpleRecordImport(MagentoImportSynchronizer):
@@ -288,12 +617,25 @@ class SimpleRecordImport(MagentoImportSynchronizer):
     ]
 
 
+# Priority of the jobs importing the translations, lower than the
+# imports of the records (10)
+TRANSLATION_IMPORT_PRIORITY = 15
+
+# Translatable fields of the models
+_translatable_fields_cache = WorkerCache()
+
+
 @magento
 class TranslationImporter(ImportSynchronizer):
     """ Import translations for a record.
 
     Usually called from importers, in ``_after_import``.
-    For instance from the products and products' categories importers.
+    For instance from the products and products' categories importers,
+    or delayed in a job with :func:`import_translations`.
+
+    The translations of many records can be imported together with
+    :meth:`run_batch`: the records are read in all the storeviews in
+    ``multiCall`` requests.
     """
 
     _model_name = ['magento.product.category',
@@ -304,41 +646,71 @@ class TranslationImporter(ImportSynchronizer):
         """ Return the raw Magento data for ``self.magento_id`` """
         return self.backend_adapter.read(self.magento_id, storeview_id)
 
+    def _get_lang_storeviews(self):
+        """ Return the storeviews having a language other than the
+        default language of the backend
+
+        :return: list of (magento id of the storeview, language code)
+        """
+        config = backend_config(self.environment)
+        return [(magento_id, lang_code)
+                for magento_id, lang_code in config.storeviews
+                if lang_code and lang_code != config.default_lang_code]
+
+    def _get_translatable_fields(self):
+        """ Return the translatable fields of the model """
+        def compute():
+            session = self.session
+            fields = self.model.fields_get(session.cr, session.uid,
+                                           context=session.context)
+            return [field for field, attrs in fields.iteritems()
+                    if attrs.get('translate')]
+        key = (self.session.cr.dbname, self.model._name)
+        return _translatable_fields_cache.get(key, compute)
+
     def run(self, magento_id, binding_id, mapper_class=None):
         self.magento_id = magento_id
-        session = self.session
-        storeview_ids = session.search(
-            'magento.storeview',
-            [('backend_id', '=', self.backend_record.id)])
-        storeviews = session.browse('magento.storeview', storeview_ids)
-        default_lang = self.backend_record.default_lang_id
-        lang_storeviews = [sv for sv in storeviews
-                           if sv.lang_id and sv.lang_id != default_lang]
-        if not lang_storeviews:
-            return
+        self.run_batch([(magento_id, binding_id)], mapper_class=mapper_class)
 
-        # find the translatable fields of the model
-        fields = self.model.fields_get(session.cr, session.uid,
-                                       context=session.context)
-        translatable_fields = [field for field, attrs in fields.iteritems()
-                               if attrs.get('translate')]
+    def run_batch(self, records, mapper_class=None):
+        """ Import the translations of many records
+
+        :param records: list of tuples (magento id, binding id)
+        """
+        lang_storeviews = self._get_lang_storeviews()
+        if not lang_storeviews or not records:
+            return
+        translatable_fields = self._get_translatable_fields()
 
         if mapper_class is None:
             mapper = self.mapper
         else:
             mapper = self.get_connector_unit_for_model(mapper_class)
 
-        for storeview in lang_storeviews:
-            lang_record = self._get_magento_data(storeview.magento_id)
-            map_record = mapper.map_record(lang_record)
-            record = map_record.values()
-
-            data = dict((field, value) for field, value in record.iteritems()
-                        if field in translatable_fields)
-
-            ctx = {'connector_no_export': True, 'lang': storeview.lang_id.code}
+        adapter = self.backend_adapter
+        batch = adapter.batch()
+        reads = [(lang_code,
+                  [(binding_id, batch.add(adapter.read,
+                                          magento_id,
+                                          storeview_id))
+                   for magento_id, binding_id in records])
+                 for storeview_id, lang_code in lang_storeviews]
+        batch.flush()
+
+        for lang_code, lang_reads in reads:
+            ctx = {'connector_no_export': True, 'lang': lang_code}
             with self.session.change_context(ctx):
-                self.session.write(self.model._name, binding_id, data)
+                for binding_id, read in lang_reads:
+                    try:
+                        lang_record = read.result()
+                    except IDMissingInBackend:
+                        continue
+                    map_record = mapper.map_record(lang_record)
+                    record = map_record.values()
+                    data = dict((field, value) for field, value
+                                in record.iteritems()
+                                if field in translatable_fields)
+                    self.session.write(self.model._name, binding_id, data)
 
 
 @magento
@@ -371,8 +743,106 @@ def import_batch(session, model_name, backend_id, filters=None):
 
 @job
 @related_action(action=link)
-def import_record(session, model_name, backend_id, magento_id, force=False):
-    """ Import a record from Magento """
+def import_record(session, model_name, backend_id, magento_id, force=False,
+                  payload_id=None):
+    """ Import a record from Magento
+
+    :param payload_id: id of the ``magento.import.payload`` holding the
+                       data of the record read before the job was
+                       created, they are used only when they are still
+                       current (see ``MagentoImportSynchronizer.is_current``)
+    """
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(MagentoImportSynchronizer)
+    if not payload_id:
+        importer.run(magento_id, force=force)
+        return
+    payload_obj = session.pool['magento.import.payload']
+    record = payload_obj.load_pending(session.cr, session.uid, payload_id,
+                                      context=session.context)
+    if record is not None and not importer.is_current(record):
+        record = None
+    importer.run(magento_id, force=force, record=record)
+    if payload_obj.exists(session.cr, session.uid, payload_id):
+        payload_obj.mark_done(session.cr, session.uid, [payload_id],
+                              context=session.context)
+
+
+@job
+@related_action(action=link)
+def fetch_record(session, model_name, backend_id, magento_id, force=False):
+    """ Read a record from Magento and delay its import from the
+    stored data """
+    env = get_environment(session, model_name, backend_id)
+    adapter = env.get_connector_unit(BackendAdapter)
+    try:
+        record = adapter.read(magento_id)
+    except IDMissingInBackend:
+        return _('Record does no longer exist in Magento')
+    payload_obj = session.pool['magento.import.payload']
+    payload_id = payload_obj.store(session.cr, session.uid, backend_id,
+                                   model_name, magento_id, record,
+                                   context=session.context)
+    apply_payload.delay(session, model_name, backend_id, payload_id,
+                        force=force)
+
+
+@job
+def apply_payload(session, model_name, backend_id, payload_id, force=False):
+    """ Import a record from its data stored by ``fetch_record`` """
+    payload_obj = session.pool['magento.import.payload']
+    if not payload_obj.exists(session.cr, session.uid, payload_id):
+        return _('The data to import do no longer exist')
+    record = payload_obj.load(session.cr, session.uid, payload_id,
+                              context=session.context)
+    magento_id = payload_obj.read(session.cr, session.uid, payload_id,
+                                  ['magento_id'],
+                                  context=session.context)['magento_id']
     env = get_environment(session, model_name, backend_id)
     importer = env.get_connector_unit(MagentoImportSynchronizer)
-    importer.run(magento_id, force=force)
+    result = importer.run(magento_id, force=force, record=record)
+    payload_obj.mark_done(session.cr, session.uid, [payload_id],
+                          context=session.context)
+    return result
+
+
+@job
+def import_record_chunk(session, model_name, backend_id, magento_ids,
+                        force=False):
+    """ Import a chunk of records from Magento """
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(RecordChunkImport)
+    return importer.run(magento_ids, force=force)
+
+
+@job
+@related_action(action=link)
+def import_translations(session, model_name, backend_id, magento_id,
+                        binding_id, mapper_class=None):
+    """ Import the translations of a record from Magento """
+    model = session.pool[model_name]
+    if not model.exists(session.cr, session.uid, binding_id):
+        return _('Record does no longer exist in OpenERP')
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(TranslationImporter)
+    importer.run(magento_id, binding_id, mapper_class=mapper_class)
+
+
+@job
+def import_translations_batch(session, model_name, backend_id, records,
+                              mapper_class=None):
+    """ Import the translations of many records from Magento
+
+    :param records: list of tuples (magento id, binding id)
+    """
+    if not records:
+        return
+    model = session.pool[model_name]
+    existing_ids = set(model.exists(session.cr, session.uid,
+                                    [binding_id for __, binding_id
+                                     in records]))
+    records = [(magento_id, binding_id) for magento_id, binding_id
+               in records if binding_id in existing_ids]
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(TranslationImporter)
+    importer.run_batch(records, mapper_class=mapper_class)
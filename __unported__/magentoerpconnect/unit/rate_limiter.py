@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Limitation of the calls done on a Magento backend.
+
+Two limits are configured on the backend:
+
+* the number of simultaneous calls, shared by all the workers: a call
+  takes one of the slots of the backend, which are PostgreSQL advisory
+  locks taken on a connection dedicated to the limiter;
+* the number of calls per second of a worker process (token bucket).
+
+Both limits are adaptive: they are halved when Magento answers with
+5xx errors, network errors or when its response time exceeds the
+configured threshold, then slowly raised again while the calls succeed.
+The adaptation is done by each worker process from its own calls, it is
+not shared between the workers: a worker uses fewer of the shared slots
+only after it has itself seen Magento overloaded.
+
+When a slot cannot be obtained in time, a
+:class:`~openerp.addons.connector.exception.RetryableJobError` is
+raised so the job is postponed instead of overloading Magento.
+
+"""
+
+import logging
+import random
+import threading
+import time
+
+import openerp
+from openerp.addons.connector.exception import RetryableJobError
+
+_logger = logging.getLogger(__name__)
+
+# Maximum time (in seconds) waited for a slot or a token before giving up
+ACQUIRE_TIMEOUT = 60
+# Bounds (in seconds) of the random delay between 2 attempts to get a slot
+SLOT_RETRY_DELAY = (0.05, 0.5)
+# Faults of the calls (see ``api_stats``) showing that Magento is
+# overloaded, in addition to the HTTP 5xx errors
+OVERLOAD_FAULTS = ('network',)
+# The limits are multiplied by this ratio when Magento is overloaded...
+DECREASE_RATIO = 0.5
+# ... at most once in this delay (in seconds)
+DECREASE_COOLDOWN = 5
+# ... and increased by this step on each successful call
+INCREASE_STEP = 0.05
+# The limits are never lowered below this ratio of the configured ones
+MIN_FACTOR = 0.1
+# Namespace of the advisory locks used as slots, a lock is identified by
+# the namespace, the id of the backend and the number of the slot
+LOCK_NAMESPACE = 0x4d41
+
+
+def is_overload_fault(fault):
+    """ Return True when the fault of a call (see ``api_stats``) shows
+    that Magento is overloaded: network errors and HTTP 5xx errors """
+    if not fault:
+        return False
+    return fault in OVERLOAD_FAULTS or fault.startswith('http 5')
+
+
+class BackendLimiter(object):
+    """ Limits of a backend in the current process """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.max_concurrency = 0
+        self.rate = 0.
+        self.latency_threshold = 0.
+        self.factor = 1.
+        self.tokens = 0.
+        self.last_refill = time.time()
+        self.last_decrease = 0.
+        # slots locked by the current process, the advisory locks are
+        # reentrant so a thread must not take a slot held by another one
+        self.held_slots = set()
+
+    def configure(self, max_concurrency, rate, latency_threshold):
+        with self._lock:
+            self.max_concurrency = max_concurrency
+            self.rate = rate
+            self.latency_threshold = latency_threshold
+
+    @property
+    def slot_count(self):
+        """ Number of slots usable with the current adaptive factor """
+        return max(1, int(self.max_concurrency * self.factor))
+
+    def take_token(self):
+        """ Take a token from the bucket
+
+        :return: 0 when a token was taken, otherwise the delay to wait
+                 (in seconds) before a token is available
+        """
+        with self._lock:
+            if self.rate <= 0:
+                return 0
+            rate = self.rate * self.factor
+            now = time.time()
+            # allow bursts of 1 second of calls
+            self.tokens = min(max(rate, 1.),
+                              self.tokens + (now - self.last_refill) * rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / rate
+
+    def observe(self, duration, fault=None):
+        """ Adapt the limits according to the result of a call """
+        with self._lock:
+            overloaded = (is_overload_fault(fault) or
+                          (self.latency_threshold > 0 and
+                           duration > self.latency_threshold))
+            now = time.time()
+            if overloaded:
+                if now - self.last_decrease > DECREASE_COOLDOWN:
+                    self.factor = max(MIN_FACTOR,
+                                      self.factor * DECREASE_RATIO)
+                    self.last_decrease = now
+                    _logger.info('Magento seems overloaded, its limits '
+                                 'are lowered to %d%%', self.factor * 100)
+            elif fault is None:
+                self.factor = min(1., self.factor + INCREASE_STEP)
+
+
+class RateLimiter(object):
+    """ Limit the calls of the workers on the Magento backends """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+        # dbname -> (cursor, lock) used for the advisory locks
+        self._cursors = {}
+
+    def limiter(self, dbname, backend_id):
+        with self._lock:
+            key = (dbname, backend_id)
+            if key not in self._limiters:
+                self._limiters[key] = BackendLimiter()
+            return self._limiters[key]
+
+    def _cursor(self, dbname):
+        with self._lock:
+            if dbname not in self._cursors:
+                cr = openerp.sql_db.db_connect(dbname).cursor()
+                cr.autocommit(True)
+                self._cursors[dbname] = (cr, threading.Lock())
+            return self._cursors[dbname]
+
+    def _drop_cursor(self, dbname):
+        with self._lock:
+            cr, __ = self._cursors.pop(dbname, (None, None))
+            # the locks are released with the connection
+            for (limiter_db, __), limiter in self._limiters.iteritems():
+                if limiter_db == dbname:
+                    limiter.held_slots.clear()
+        if cr is not None:
+            try:
+                cr.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _lock_key(backend_id, slot):
+        return (LOCK_NAMESPACE << 40) + (backend_id << 16) + slot
+
+    def _lock_slot(self, dbname, backend_id, limiter):
+        """ Lock a free slot of the backend
+
+        :return: the number of the slot, None if no slot is free
+        """
+        cr, cr_lock = self._cursor(dbname)
+        with cr_lock:
+            for slot in xrange(limiter.slot_count):
+                if slot in limiter.held_slots:
+                    continue
+                cr.execute("SELECT pg_try_advisory_lock(%s)",
+                           (self._lock_key(backend_id, slot),))
+                if cr.fetchone()[0]:
+                    limiter.held_slots.add(slot)
+                    return slot
+        return None
+
+    def _unlock_slot(self, dbname, backend_id, limiter, slot):
+        cr, cr_lock = self._cursor(dbname)
+        with cr_lock:
+            limiter.held_slots.discard(slot)
+            cr.execute("SELECT pg_advisory_unlock(%s)",
+                       (self._lock_key(backend_id, slot),))
+
+    def acquire(self, dbname, backend):
+        """ Wait until a call is allowed on the backend
+
+        :param backend: ``BackendConfig`` of the ``magento.backend``
+        :return: the slot to give back to :meth:`release`, None when
+                 the concurrency is not limited
+        :raise: :class:`RetryableJobError` when the call is not allowed
+                after ``ACQUIRE_TIMEOUT`` seconds
+        """
+        limiter = self.limiter(dbname, backend.id)
+        limiter.configure(backend.api_max_concurrency or 0,
+                          backend.api_rate_limit or 0.,
+                          backend.api_latency_threshold or 0.)
+        deadline = time.time() + ACQUIRE_TIMEOUT
+        while True:
+            wait = limiter.take_token()
+            if not wait:
+                break
+            if time.time() + wait > deadline:
+                raise RetryableJobError(
+                    'Too many calls on the Magento backend %s, '
+                    'the job will be retried later.' % backend.name)
+            time.sleep(wait)
+        if limiter.max_concurrency <= 0:
+            return None
+        while True:
+            try:
+                slot = self._lock_slot(dbname, backend.id, limiter)
+            except Exception:
+                # the limiter must not break the synchronizations
+                _logger.exception('Could not lock a slot for the Magento '
+                                  'backend %s', backend.name)
+                self._drop_cursor(dbname)
+                return None
+            if slot is not None:
+                return slot
+            if time.time() > deadline:
+                raise RetryableJobError(
+                    'Too many concurrent calls on the Magento backend %s, '
+                    'the job will be retried later.' % backend.name)
+            time.sleep(random.uniform(*SLOT_RETRY_DELAY))
+
+    def release(self, dbname, backend_id, slot, duration, fault=None):
+        """ Free the slot taken by :meth:`acquire` and adapt the limits
+        with the result of the call """
+        limiter = self.limiter(dbname, backend_id)
+        limiter.observe(duration, fault=fault)
+        if slot is None:
+            return
+        try:
+            self._unlock_slot(dbname, backend_id, limiter, slot)
+        except Exception:
+            # the session-level locks are released with the connection
+            _logger.exception('Could not unlock a slot of the Magento '
+                              'backend %s', backend_id)
+            self._drop_cursor(dbname)
+
+
+rate_limiter = RateLimiter()
+""" Limiter of the calls of the current process """
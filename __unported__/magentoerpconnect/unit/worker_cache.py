@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright 2026 The connector-magento contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Caches kept by a worker process between its jobs.
+
+A worker does not see the changes done by the other workers, so an
+entry is validated on each access:
+
+* the entries of data stored in the database have a version, read with
+  a cheap query by the caller (for instance the last ``write_date`` of
+  the records), the entry is computed again when the version changed;
+* all the entries expire after ``timeout`` seconds.
+
+"""
+
+import threading
+import time
+
+# Default lifetime (in seconds) of the entries
+DEFAULT_TIMEOUT = 300
+
+
+class WorkerCache(object):
+    """ Cache of values computed by the workers, thread-safe """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, compute, version=None):
+        """ Return the value cached for ``key``, or compute and cache it
+
+        :param compute: callable returning the value
+        :param version: version of the value, a cached value with
+                        another version is computed again
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is not None:
+            cached_time, cached_version, value = cached
+            if (cached_version == version and
+                    cached_time > now - self.timeout):
+                return value
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now, version, value)
+        return value
+
+    def clear(self):
+        """ Remove all the entries """
+        with self._lock:
+            self._entries.clear()
@@ -99,6 +99,9 @@ class ProductPriceExporter(MagentoBaseExporter):
         # export the price for websites if they have a different
         # pricelist
         storeview_binder = self.get_binder_for_model('magento.storeview')
+        # the updates of all the websites are sent in one multiCall
+        batch = self.backend_adapter.batch()
+        updates = []
         for website in self.backend_record.website_ids:
             if website_id is not None and website.id != website_id:
                 continue
@@ -125,7 +128,10 @@ class ProductPriceExporter(MagentoBaseExporter):
                 continue
             magento_storeview = storeview_binder.to_backend(storeview_ids[0])
             price = self._get_price(site_pricelist_id)
-            self._update({'price': price}, storeview_id=magento_storeview)
+            updates.append(batch.add(self._update, {'price': price},
+                                     storeview_id=magento_storeview))
+        for update in updates:
+            update.result()
         self.binder.bind(self.magento_id, self.binding_id)
         return _('Prices have been updated.')
 